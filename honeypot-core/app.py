@@ -1,40 +1,136 @@
-from flask import Flask, request, jsonify, make_response, g
+import sys
+
+import orjson
+from flask import Flask, Response, request, jsonify, make_response, g
+from flask.json.provider import DefaultJSONProvider
 from logger import (
-    log_event, log_deception, upsert_session,
-    check_credentials, user_exists, get_user_role,
-    record_session_activity, create_alert,
+    log_event, upsert_session, dispatch_event,
+    lookup_user, verify_password,
     get_overview, list_sessions, get_session, list_alerts, list_events, list_deceptions
 )
 
 from logger import update_session_max_risk
 
-from deception_engine import generate_deception  # <-- use updated engine module
+from deception_engine import generate_deception, push_event  # <-- use updated engine module
 
 
 # Person 3 pipeline
 from detection import DetectionPipeline, detection_bp, init_api
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson (used by jsonify and request.get_json).
+    Documents orjson rejects but the stdlib accepts (NaN, Infinity, floats
+    out of double range) fall back to the default provider. Integers wider
+    than 64 bits are read by orjson as floats, unlike json.loads; that keeps
+    them encodable by the orjson/BSON writers downstream.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+        except orjson.JSONEncodeError:
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return super().loads(s, **kwargs)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 PIPELINE = DetectionPipeline()
 init_api(PIPELINE)
 app.register_blueprint(detection_bp)
 
+# Only these request headers are kept on logged events / LLM context.
+HEADER_ALLOWLIST = (
+    "Host", "User-Agent", "Referer", "X-Forwarded-For",
+    "Accept", "Content-Type", "Cookie", "Authorization",
+)
+
+
+# Liveness probes and the dashboards' own polling are not attack surface:
+# they skip logging and the detection pipeline entirely.
+_SKIP_PATHS = frozenset({"/health"})
+_SKIP_PREFIXES = ("/dashboard/api/", "/api/detection/")
+
+
+def _capture_identity(environ) -> None:
+    """Sets honeypot.skip and, for captured paths, honeypot.ip/ua/session_id."""
+    path = environ.get("PATH_INFO") or "/"
+    skip = path in _SKIP_PATHS or path.startswith(_SKIP_PREFIXES)
+    environ["honeypot.skip"] = skip
+    if not skip:
+        ip = environ.get("REMOTE_ADDR")
+        ua = environ.get("HTTP_USER_AGENT")
+        environ["honeypot.ip"] = ip
+        environ["honeypot.ua"] = ua
+        environ["honeypot.session_id"] = sys.intern(f"{ip}|{ua or ''}")
+
+
+class _CaptureMiddleware:
+    """
+    Reads the caller's identity straight from the WSGI environ, before Flask
+    builds its request context, and leaves it in environ for capture_request.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        _capture_identity(environ)
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = _CaptureMiddleware(app.wsgi_app)
+
+
+def _captured_headers() -> dict:
+    headers = request.headers
+    return {k: v for k in HEADER_ALLOWLIST if (v := headers.get(k)) is not None}
+
+
 def _session_id() -> str:
-    return f"{request.remote_addr}|{request.headers.get('User-Agent','')}"
+    # Computed once per request by _capture_identity.
+    return g.session_id
 
 
 @app.before_request
 def capture_request():
+    # Set first so score_request can read them even if capture fails below.
+    g.current_event = None
+    g.ai_risk_score = None
+
+    environ = request.environ
+    if "honeypot.skip" not in environ:
+        # Served without _CaptureMiddleware (e.g. app.wsgi_app wrapped again)
+        _capture_identity(environ)
+    if environ["honeypot.skip"]:
+        return
+
+    # Set by _capture_identity
+    g.ip = ip = environ["honeypot.ip"]
+    g.ua = ua = environ["honeypot.ua"]
+    g.session_id = environ["honeypot.session_id"]
+    g.body = request.get_json(silent=True)  # parsed once (orjson provider)
+
     event_data = {
-        "ip": request.remote_addr,
+        "ip": ip,
         "method": request.method,
         "path": request.path,
-        "headers": dict(request.headers),
-        "query_params": request.args.to_dict(),
-        "body": request.get_json(silent=True),
-        "user_agent": request.headers.get("User-Agent"),
-        "session_id": _session_id(),
+        "headers": _captured_headers(),
+        "query_params": request.args.to_dict() if request.query_string else {},
+        "body": g.body,
+        "user_agent": ua,
+        "session_id": g.session_id,
     }
 
     event = log_event(event_data)
@@ -45,17 +141,18 @@ def capture_request():
     })
 
     g.current_event = event
-    g.ai_risk_score = None
 
 
 @app.after_request
 def score_request(response):
-    try:
-        event = getattr(g, "current_event", None)
-        if event is not None:
-            PIPELINE.process_event(event, ai_risk_score=getattr(g, "ai_risk_score", None))
-    except Exception as e:
-        print(f"[DETECTION_PIPELINE_ERROR] {e}")
+    # capture_request always sets both; process_event handles its own errors.
+    event = g.current_event
+    if event is not None:
+        # Prompt context for the deception engine, recorded only after the
+        # route ran so the engine sees prior requests, not this one. No
+        # timestamp: it would make every prompt unique and defeat the LLM cache.
+        push_event(event["session_id"], {"path": event["path"], "method": event["method"]})
+        PIPELINE.process_event(event, ai_risk_score=g.ai_risk_score)
 
     return response
 
@@ -69,11 +166,11 @@ def _build_current_request(path_override: str | None = None) -> dict:
     return {
         "path": path_override or request.path,
         "method": request.method,
-        "ip": request.remote_addr,
-        "user_agent": request.headers.get("User-Agent"),
-        "headers": dict(request.headers),
-        "body": request.get_json(silent=True),
-        "session_id": _session_id(),
+        "ip": g.ip,
+        "user_agent": g.ua,
+        "headers": _captured_headers(),
+        "body": g.body,
+        "session_id": g.session_id,
     }
 
 
@@ -99,13 +196,12 @@ def login():
     recent_events = []
     deception = generate_deception(recent_events, current_req)
 
-    body = request.get_json(silent=True) or {}
+    body = g.body or {}
     username = str(body.get("username") or body.get("email") or "")
     password = str(body.get("password") or "")
 
-    exists = user_exists(username) if username else False
-    valid = check_credentials(username, password) if username else False
-    role = get_user_role(username) if exists else None
+    exists, pw_hash, role = lookup_user(username)
+    valid = verify_password(password, pw_hash)
 
     risk = int(deception.get("risk_score") or 0)
     flags = ["login_attempt"]
@@ -132,53 +228,56 @@ def login():
 
     g.ai_risk_score = risk
 
-    # Update sessions for dashboard
-    record_session_activity(
-        current_req["session_id"],
-        ip=current_req["ip"],
-        user_agent=current_req["user_agent"],
-        path="/login",
-        method=request.method,
-        status_code=int(deception["fake_response"]["status_code"]),
-        risk=risk,
-        flags=flags,
-        counters_inc=counters,
-    )
+    status_code = int(deception["fake_response"]["status_code"])
 
-    # Create alerts
+    # Create alerts (session/ip/user_agent come from session_activity)
+    alerts = []
     if "valid_creds" in flags:
-        create_alert(
-            current_req["session_id"], current_req["ip"], current_req["user_agent"],
+        alerts.append(dict(
             severity="CRITICAL",
             alert_type="valid_creds",
             reason=f"Valid credentials used for username={username} role={role}",
             risk=risk,
-        )
+        ))
     elif "admin_user_targeted" in flags:
-        create_alert(
-            current_req["session_id"], current_req["ip"], current_req["user_agent"],
+        alerts.append(dict(
             severity="HIGH",
             alert_type="admin_target",
             reason=f"Admin user targeted: username={username}",
             risk=risk,
-        )
-
-    log_deception({
-        "session_id": current_req["session_id"],
-        "path": "/login",
-        "method": request.method,
-        "ip": current_req["ip"],
-        "user_agent": current_req["user_agent"],
-        "risk_score": risk,
-        "flags": flags,
-        "credential_intel": {"username": username, "exists": exists, "valid": valid, "role": role},
-        "served_response": {
-            "status_code": int(deception["fake_response"]["status_code"]),
-            "content_type": deception["fake_response"]["content_type"],
+        ))
+
+    # Session update, alerts and deception record go out as one queued write
+    dispatch_event("login", {
+        "session_activity": dict(
+            session_id=current_req["session_id"],
+            ip=current_req["ip"],
+            user_agent=current_req["user_agent"],
+            path="/login",
+            method=request.method,
+            status_code=status_code,
+            risk=risk,
+            flags=flags,
+            counters_inc=counters,
+        ),
+        "alerts": alerts,
+        "deception": {
+            "session_id": current_req["session_id"],
+            "path": "/login",
+            "method": request.method,
+            "ip": current_req["ip"],
+            "user_agent": current_req["user_agent"],
+            "risk_score": risk,
+            "flags": flags,
+            "credential_intel": {"username": username, "exists": exists, "valid": valid, "role": role},
+            "served_response": {
+                "status_code": status_code,
+                "content_type": deception["fake_response"]["content_type"],
+            },
+            "fake_logs": deception.get("fake_logs"),
+            "fake_creds": deception.get("fake_creds"),
+            "suggested_endpoints": deception.get("suggested_endpoints"),
         },
-        "fake_logs": deception.get("fake_logs"),
-        "fake_creds": deception.get("fake_creds"),
-        "suggested_endpoints": deception.get("suggested_endpoints"),
     })
 
     return _serve_deception(deception)
@@ -193,8 +292,7 @@ def admin():
     deception = generate_deception(recent_events, current_req)
 
     as_user = request.args.get("as_user", "")  # test hook
-    exists = user_exists(as_user) if as_user else False
-    role = get_user_role(as_user) if exists else None
+    exists, _, role = lookup_user(as_user)
 
     risk = int(deception.get("risk_score") or 0)
     risk = max(risk, 60)
@@ -211,48 +309,50 @@ def admin():
 
     g.ai_risk_score = risk
 
-    record_session_activity(
-        current_req["session_id"],
-        ip=current_req["ip"],
-        user_agent=current_req["user_agent"],
-        path="/admin",
-        method=request.method,
-        status_code=int(deception["fake_response"]["status_code"]),
-        risk=risk,
-        flags=flags,
-        counters_inc=counters,
-    )
+    status_code = int(deception["fake_response"]["status_code"])
 
-    # Alerts
+    # Alerts (session/ip/user_agent come from session_activity)
     if "admin_role_probe" in flags:
-        create_alert(
-            current_req["session_id"], current_req["ip"], current_req["user_agent"],
+        alert = dict(
             severity="CRITICAL",
             alert_type="admin_probe",
             reason=f"Admin panel probing as admin user={as_user}",
             risk=risk,
         )
     else:
-        create_alert(
-            current_req["session_id"], current_req["ip"], current_req["user_agent"],
+        alert = dict(
             severity="HIGH",
             alert_type="admin_probe",
             reason="Admin panel probing detected",
             risk=risk,
         )
 
-    log_deception({
-        "session_id": current_req["session_id"],
-        "path": "/admin",
-        "method": request.method,
-        "ip": current_req["ip"],
-        "user_agent": current_req["user_agent"],
-        "risk_score": risk,
-        "flags": flags,
-        "admin_intel": {"as_user": as_user, "exists": exists, "role": role},
-        "served_response": {
-            "status_code": int(deception["fake_response"]["status_code"]),
-            "content_type": deception["fake_response"]["content_type"],
+    dispatch_event("admin", {
+        "session_activity": dict(
+            session_id=current_req["session_id"],
+            ip=current_req["ip"],
+            user_agent=current_req["user_agent"],
+            path="/admin",
+            method=request.method,
+            status_code=status_code,
+            risk=risk,
+            flags=flags,
+            counters_inc=counters,
+        ),
+        "alerts": [alert],
+        "deception": {
+            "session_id": current_req["session_id"],
+            "path": "/admin",
+            "method": request.method,
+            "ip": current_req["ip"],
+            "user_agent": current_req["user_agent"],
+            "risk_score": risk,
+            "flags": flags,
+            "admin_intel": {"as_user": as_user, "exists": exists, "role": role},
+            "served_response": {
+                "status_code": status_code,
+                "content_type": deception["fake_response"]["content_type"],
+            },
         },
     })
 
@@ -317,31 +417,46 @@ def api_create_test_alert():
 
 @app.route("/api/<path:subpath>", methods=["GET", "POST"])
 def api(subpath):
-    return jsonify({"status": "api endpoint reached", "path": subpath})
+    return Response(
+        orjson.dumps({"status": "api endpoint reached", "path": subpath}),
+        mimetype="application/json",
+    )
+
+
+# Constant bodies, serialized once at import.
+_BACKUP_BODY = b"FAKE_DB_BACKUP\nuser: admin\npassword: fake123"
+_BACKUP_HEADERS = {
+    "Content-Type": "text/plain; charset=utf-8",
+    "Content-Disposition": "attachment; filename=backup.sql",
+}
+_CONFIG_BODY = orjson.dumps({
+    "DB_HOST": "localhost",
+    "DB_USER": "admin",
+    "DB_PASSWORD": "fake_password"
+})
+_HEALTH_BODY = orjson.dumps({"status": "healthy"})
 
 
 @app.route("/backup")
 def backup():
-    fake_backup = "FAKE_DB_BACKUP\nuser: admin\npassword: fake123"
-    response = make_response(fake_backup)
-    response.headers["Content-Disposition"] = "attachment; filename=backup.sql"
-    response.headers["Content-Type"] = "text/plain; charset=utf-8"
-    return response
+    return Response(_BACKUP_BODY, status=200, headers=_BACKUP_HEADERS)
 
 
 @app.route("/config")
 def config():
-    return jsonify({
-        "DB_HOST": "localhost",
-        "DB_USER": "admin",
-        "DB_PASSWORD": "fake_password"
-    })
+    return Response(_CONFIG_BODY, mimetype="application/json")
+
+
+@app.route("/health")
+def health():
+    return Response(_HEALTH_BODY, mimetype="application/json")
 
 
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    # Local development only; deploy with `gunicorn app:app` (see gunicorn.conf.py).
+    app.run(host="0.0.0.0", port=8080, threaded=True)
 
 
 
@@ -1,16 +1,30 @@
 # deception_engine.py
 from __future__ import annotations
 
-import json
+import asyncio
+import atexit
 import os
 import re
 import time
-import uuid
+import secrets
+import string
 import hashlib
 import random
-from typing import Any, Dict, List, Optional
-
-from langchain_openai import AzureChatOpenAI
+import threading
+import weakref
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from typing import Annotated, Any, Callable, Dict, List, Literal, Optional, Tuple, Union
+
+import httpx
+import msgspec
+import orjson
+from cachetools import TTLCache
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_openai import AzureChatOpenAI, ChatOpenAI
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -19,6 +33,9 @@ load_dotenv()
 # PROMPTS
 # ----------------------------
 
+# Everything above ---CONTEXT--- is fixed text, so each route sends a
+# byte-identical prefix that provider-side prompt caching can reuse. The
+# per-request context goes last, most stable first.
 LOGIN_PROMPT = """\
 You are an AI deception engine for a cybersecurity honeypot.
 
@@ -31,11 +48,6 @@ Rules:
 - Use plausible fake patterns (svc_auth, tok_xxx).
 - Response must look like a real authentication API error.
 
-Context:
-env_profile: {env_profile_json}
-recent_events: {recent_events_json}
-current_request: {current_request_json}
-
 Return JSON with EXACT keys:
 fake_response {{
   content_type: "application/json",
@@ -53,6 +65,11 @@ fake_creds {{ username, password_hint, token_sample, notes }}
 fake_logs [strings]
 suggested_endpoints [strings]
 risk_score (0-100)
+
+---CONTEXT---
+env_profile: {env_profile_json}
+recent_events: {recent_events_json}
+current_request: {current_request_json}
 """
 
 ADMIN_PROMPT = """\
@@ -68,11 +85,6 @@ Rules:
 - Include subtle security warnings and audit language.
 - No real credentials or secrets.
 
-Context:
-env_profile: {env_profile_json}
-recent_events: {recent_events_json}
-current_request: {current_request_json}
-
 Return JSON with EXACT keys:
 fake_response {{
   content_type: "text/html",
@@ -89,6 +101,11 @@ HTML body should include:
 - "Access Denied" or "Unauthorized"
 - Reference to audit logging
 - Professional admin UI tone
+
+---CONTEXT---
+env_profile: {env_profile_json}
+recent_events: {recent_events_json}
+current_request: {current_request_json}
 """
 
 
@@ -96,23 +113,102 @@ HTML body should include:
 # Stateful env profile per attacker
 # ----------------------------
 
-_SESSION: Dict[str, Dict[str, Any]] = {}
+# Per-session state, bounded and expired so a large attacker population
+# can't grow it without limit; push_event refreshes an active session's TTL.
+# TTLCache is not thread-safe; hold the lock.
+_SESSION: TTLCache = TTLCache(
+    maxsize=int(os.getenv("DECEPTION_SESSION_MAX", "10000")),
+    ttl=float(os.getenv("DECEPTION_SESSION_TTL", "3600")),
+)
+_SESSION_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=8192)
+def _sid_from_ip_ua(ip: str, ua: str) -> str:
+    # Only needs to be unique per ip|ua; 12-byte BLAKE2b gives the same
+    # 24 hex chars as the old truncated SHA-256 for less work.
+    return hashlib.blake2b(f"{ip}|{ua}".encode("utf-8"), digest_size=12).hexdigest()
 
 
 def _session_id(req: Dict[str, Any]) -> str:
     sid = req.get("session_id")
     if sid:
         return str(sid)
-    ip = str(req.get("ip", "unknown"))
-    ua = str(req.get("user_agent", "unknown"))
-    return hashlib.sha256(f"{ip}|{ua}".encode("utf-8")).hexdigest()[:24]
+    return _sid_from_ip_ua(str(req.get("ip", "unknown")), str(req.get("user_agent", "unknown")))
+
 
+def _session_state(sid: str) -> Dict[str, Any]:
+    # caller holds _SESSION_LOCK
+    sess = _SESSION.get(sid)
+    if sess is None:
+        sess = _SESSION[sid] = {}
+    return sess
 
-def _get_env_profile(sid: str) -> Dict[str, Any]:
-    if sid in _SESSION and "env_profile" in _SESSION[sid]:
-        return _SESSION[sid]["env_profile"]
 
-    seed = int(hashlib.sha256(sid.encode("utf-8")).hexdigest()[:8], 16)
+def _session_profile(sid: str) -> Tuple[Dict[str, Any], str]:
+    """
+    (env_profile, its prompt JSON). The profile never changes for a session,
+    so both are stored together when the session first needs them.
+    """
+    with _SESSION_LOCK:
+        sess = _session_state(sid)
+        if "env_profile" not in sess:
+            env = _build_env_profile(sid)
+            sess["env_profile"] = env
+            sess["env_profile_json"] = _dumps(env)
+        return sess["env_profile"], sess["env_profile_json"]
+
+
+RECENT_EVENTS_MAX = 20
+
+
+def push_event(session_id: str, event: Dict[str, Any]) -> None:
+    """
+    Record an event for the session's prompt context. Each event is
+    serialized once here; prompts join the last RECENT_EVENTS_MAX fragments.
+    """
+    frag = _dumps(event)
+    path = str(event.get("path", "")).lower()
+    with _SESSION_LOCK:
+        sess = _session_state(session_id)
+        # Re-inserting restarts the entry's TTL, so the session expires an
+        # hour after its last event rather than an hour after it started.
+        _SESSION[session_id] = sess
+        ring = sess.get("events")
+        if ring is None:
+            ring = sess["events"] = deque(maxlen=RECENT_EVENTS_MAX)
+            sess["paths"] = deque(maxlen=RECENT_EVENTS_MAX)
+            sess["hits"] = {"/login": 0, "/admin": 0}
+
+        # Keep /login and /admin counts over the window in step with the ring
+        paths, hits = sess["paths"], sess["hits"]
+        if len(paths) == RECENT_EVENTS_MAX:
+            evicted = paths[0]
+            if evicted in hits:
+                hits[evicted] -= 1
+        if path in hits:
+            hits[path] += 1
+        paths.append(path)
+        ring.append(frag)
+
+
+def _recent_events_json(sid: str) -> str:
+    with _SESSION_LOCK:
+        ring = _session_state(sid).get("events") or ()
+        return "[" + ",".join(ring) + "]"
+
+
+# Deletes everything but [a-z0-9] from the (ASCII) org names
+_DOMAIN_STRIP = str.maketrans("", "", "".join(
+    c for c in map(chr, range(128)) if c not in string.ascii_lowercase + string.digits
+))
+
+
+# Deterministic from sid, so a profile that expired from _SESSION comes back
+# identical; the cache only spares the hash/random/regex work.
+@lru_cache(maxsize=10000)
+def _build_env_profile(sid: str) -> Dict[str, Any]:
+    seed = int.from_bytes(hashlib.blake2b(sid.encode("utf-8"), digest_size=4).digest(), "big")
     rng = random.Random(seed)
 
     orgs = [
@@ -129,7 +225,7 @@ def _get_env_profile(sid: str) -> Dict[str, Any]:
     ]
 
     org_name = rng.choice(orgs)
-    domain = re.sub(r"[^a-z0-9]+", "", org_name.lower())[:14] + ".internal"
+    domain = org_name.lower().translate(_DOMAIN_STRIP)[:14] + ".internal"
     env = {
         "org_name": org_name,
         "domain": domain,
@@ -139,166 +235,398 @@ def _get_env_profile(sid: str) -> Dict[str, Any]:
         "build_id": f"{rng.randint(10,99)}.{rng.randint(0,9)}.{rng.randint(0,99)}",
     }
 
-    _SESSION.setdefault(sid, {})["env_profile"] = env
     return env
 
 
 # ----------------------------
-# LLM init (Azure)
+# LLM init (Azure primary/secondary, OpenAI)
 # ----------------------------
 
-_LLM: Optional[AzureChatOpenAI] = None
+_LLMS: Optional[List[BaseChatModel]] = None
+_LLMS_LOCK = threading.Lock()
+_HTTP_CLIENT: Optional[httpx.Client] = None  # shared by every provider client
+
+# Hard per-route deadlines for the LLM round trip; past these the
+# deterministic fallback is served instead.
+_DEADLINE_LOGIN = float(os.getenv("DECEPTION_LLM_TIMEOUT", "1.5"))
+_DEADLINE_ADMIN = float(os.getenv("DECEPTION_LLM_TIMEOUT_ADMIN", "2.0"))
+LLM_BATCH_CONCURRENCY = int(os.getenv("DECEPTION_BATCH_CONCURRENCY", "10"))
+
+# Soft budget per provider before moving on to the next one (the last
+# available provider gets the rest of the route deadline instead), and how
+# long a provider that errored or ran out the route deadline is skipped.
+PROVIDER_BUDGET_SEC = float(os.getenv("DECEPTION_PROVIDER_BUDGET", "1.0"))
+COOLDOWN_SEC = float(os.getenv("DECEPTION_PROVIDER_COOLDOWN", "30"))
+_FAILED_AT: Dict[int, float] = {}
+
+HTTP_POOL_SIZE = int(os.getenv("DECEPTION_HTTP_POOL", "32"))
+
+_CLIENT_KWARGS = {
+    "temperature": 0.6,
+    # Let the client give up shortly after the caller has; retries would
+    # only keep abandoned calls alive.
+    "request_timeout": max(_DEADLINE_LOGIN, _DEADLINE_ADMIN),
+    "max_retries": 0,
+}
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_POOL_SIZE,
+        max_keepalive_connections=HTTP_POOL_SIZE,
+        keepalive_expiry=60.0,
+    )
 
 
-def _get_llm() -> Optional[AzureChatOpenAI]:
+def _http_client() -> httpx.Client:
     """
-    Reads configuration from env (safe: we never print values):
-      - AZURE_OPENAI_API_KEY
-      - AZURE_OPENAI_ENDPOINT
-      - AZURE_OPENAI_DEPLOYMENT
-      - AZURE_OPENAI_API_VERSION (optional, default "2024-02-01")
+    One keep-alive pool per process, shared by every provider client, so
+    calls reuse TLS connections instead of each client opening its own.
     """
-    global _LLM
-    if _LLM is not None:
-        return _LLM
+    http_client = httpx.Client(timeout=_CLIENT_KWARGS["request_timeout"], limits=_http_limits())
+    atexit.register(http_client.close)
+    return http_client
 
-    api_key = ""
-    endpoint=""
-    deployment = ""
-    api_version =""
+
+def _azure_from_env(prefix: str, http: Dict[str, Any]) -> Optional[AzureChatOpenAI]:
+    api_key = os.getenv(f"{prefix}_API_KEY", "")
+    endpoint = os.getenv(f"{prefix}_ENDPOINT", "")
+    deployment = os.getenv(f"{prefix}_DEPLOYMENT", "")
+    api_version = os.getenv(f"{prefix}_API_VERSION", "2024-02-01")
 
     if not (api_key and endpoint and deployment):
         return None
 
-    _LLM = AzureChatOpenAI(
+    return AzureChatOpenAI(
         azure_endpoint=endpoint,
         api_key=api_key,
         azure_deployment=deployment,
         api_version=api_version,
-        temperature=0.6,
+        **_CLIENT_KWARGS,
+        **http,
     )
-    return _LLM
+
+
+def _get_llms() -> List[BaseChatModel]:
+    """
+    Ranked provider list, built once from env (safe: we never print values):
+      - AZURE_OPENAI_API_KEY / _ENDPOINT / _DEPLOYMENT / _API_VERSION (primary)
+      - AZURE_OPENAI_SECONDARY_* (optional, same keys)
+      - OPENAI_API_KEY (optional), OPENAI_MODEL (default "gpt-4o-mini")
+    """
+    global _LLMS, _HTTP_CLIENT
+    if _LLMS is not None:
+        return _LLMS
+
+    # Concurrent first requests must not build (and pool connections for)
+    # the clients twice.
+    with _LLMS_LOCK:
+        if _LLMS is None:
+            _HTTP_CLIENT = _http_client()
+            llms = _build_llms({"http_client": _HTTP_CLIENT})
+            if llms:
+                _configure_llm_cache()
+            _LLMS = llms
+    return _LLMS
+
+
+# httpx async connections belong to the event loop that opened them, so each
+# loop (e.g. each asyncio.run around the async API) gets its own AsyncClient
+# and provider clients on top of it. Entries go away with their loop.
+_LOOP_LLMS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, List[BaseChatModel]]" = (
+    weakref.WeakKeyDictionary()
+)
+def _loop_llms() -> List[BaseChatModel]:
+    """_get_llms() for async callers: same ranking, bound to the running loop."""
+    if not _get_llms():
+        return []
+    loop = asyncio.get_running_loop()
+    llms = _LOOP_LLMS.get(loop)
+    if llms is None:
+        with _LLMS_LOCK:
+            llms = _LOOP_LLMS.get(loop)
+            if llms is None:
+                async_client = httpx.AsyncClient(timeout=_CLIENT_KWARGS["request_timeout"], limits=_http_limits())
+                llms = _LOOP_LLMS[loop] = _build_llms(
+                    {"http_client": _HTTP_CLIENT, "http_async_client": async_client}
+                )
+    return llms
+
+
+def _build_llms(http: Dict[str, Any]) -> List[BaseChatModel]:
+    llms: List[BaseChatModel] = [
+        llm for llm in (
+            _azure_from_env("AZURE_OPENAI", http),
+            _azure_from_env("AZURE_OPENAI_SECONDARY", http),
+        ) if llm is not None
+    ]
+    if os.getenv("OPENAI_API_KEY"):
+        llms.append(ChatOpenAI(model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"), **_CLIENT_KWARGS, **http))
+    return llms
+
+
+def _available_llms(llms: Optional[List[BaseChatModel]] = None) -> List[Tuple[int, BaseChatModel]]:
+    """Providers not in their post-failure cooldown, in rank order (of _get_llms() by default)."""
+    now = time.monotonic()
+    return [
+        (i, llm) for i, llm in enumerate(_get_llms() if llms is None else llms)
+        if now - _FAILED_AT.get(i, -COOLDOWN_SEC) >= COOLDOWN_SEC
+    ]
+
+
+# Sync callers wait on a future so the deadline holds even if the HTTP
+# client stalls; the worker thread is released once request_timeout fires.
+_LLM_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DECEPTION_LLM_WORKERS", "32")),
+    thread_name_prefix="deception-llm",
+)
+
+
+# DECEPTION_STREAM=1 streams tokens so a provider that hasn't produced its
+# first token within DECEPTION_TTFB_BUDGET is abandoned early; once tokens
+# flow it gets the rest of the route deadline.
+STREAM_RESPONSES = os.getenv("DECEPTION_STREAM", "0") == "1"
+TTFB_BUDGET_SEC = float(os.getenv("DECEPTION_TTFB_BUDGET", "0.5"))
+
+
+def _stream_text(llm: BaseChatModel, prompt: str, first_token: threading.Event, max_tokens: int) -> str:
+    chunks: List[str] = []
+    for chunk in llm.stream(prompt, max_tokens=max_tokens):
+        first_token.set()
+        chunks.append(chunk.content)
+    return "".join(chunks)
+
+
+def _invoke_with_fallback(prompt: str, deadline: float, max_tokens: int) -> Any:
+    """Tries each available provider in turn within the route deadline; None if all fail."""
+    end = time.monotonic() + deadline
+    available = _available_llms()
+    for n, (i, llm) in enumerate(available):
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        last = n == len(available) - 1
+        if STREAM_RESPONSES:
+            first_token = threading.Event()
+            fut = _LLM_EXECUTOR.submit(_stream_text, llm, prompt, first_token, max_tokens)
+        else:
+            fut = _LLM_EXECUTOR.submit(llm.invoke, prompt, max_tokens=max_tokens)
+        try:
+            if STREAM_RESPONSES:
+                wait = remaining if last else min(TTFB_BUDGET_SEC, remaining)
+                if not first_token.wait(wait):
+                    raise FuturesTimeoutError("no first token")
+                remaining = wait = max(0.0, end - time.monotonic())
+            else:
+                wait = remaining if last else min(PROVIDER_BUDGET_SEC, remaining)
+            return fut.result(timeout=wait)
+        except FuturesTimeoutError:
+            fut.cancel()
+            # Only the route deadline counts as a failure, not the soft budget.
+            if wait >= remaining:
+                _FAILED_AT[i] = time.monotonic()
+        except Exception:
+            fut.cancel()
+            _FAILED_AT[i] = time.monotonic()
+    return None
+
+
+async def _ainvoke_with_fallback(prompt: str, deadline: float, max_tokens: int) -> Any:
+    end = time.monotonic() + deadline
+    available = _available_llms(_loop_llms())
+    for n, (i, llm) in enumerate(available):
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        wait = remaining if n == len(available) - 1 else min(PROVIDER_BUDGET_SEC, remaining)
+        try:
+            return await _ainvoke_with_timeout(llm, prompt, wait, max_tokens)
+        except asyncio.TimeoutError:
+            if wait >= remaining:
+                _FAILED_AT[i] = time.monotonic()
+        except Exception:
+            _FAILED_AT[i] = time.monotonic()
+    return None
+
+
+def _configure_llm_cache() -> None:
+    """
+    DECEPTION_CACHE=memory (default) | off
+    LangChain keys cached generations on (prompt, model params). The prompt
+    carries the session's env profile and recent paths, so hits are
+    same-session only: a scanner replaying one probe reaches a steady
+    recent-events window and is then answered without an Azure round trip.
+    """
+    if os.getenv("DECEPTION_CACHE", "memory").lower() != "memory":
+        return
+    set_llm_cache(InMemoryCache(maxsize=int(os.getenv("DECEPTION_CACHE_SIZE", "4096"))))
+
+
+# Only the request fields that shape the deception go into the prompt; per-
+# request values (session_id, ip, headers) would make repeated probes within
+# a session differ and defeat the LLM cache.
+def _prompt_request(current_request: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "path": str(current_request.get("path") or "").lower(),
+        "method": current_request.get("method"),
+        "user_agent": current_request.get("user_agent"),
+        "body": current_request.get("body"),
+    }
 
 
 # ----------------------------
 # Strict JSON parsing/validation
 # ----------------------------
 
-def _parse_strict_json(text: str) -> Optional[Dict[str, Any]]:
+_JSON_OBJ_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+_BANNED = (
+    "begin private key",
+    "-----begin",
+    "sk-",
+    "azure_openai_api_key",
+    "authorization: bearer ",
+)
+# One pass over the dump instead of one scan per banned string; IGNORECASE
+# replaces lowercasing the whole payload first.
+_BANNED_RE = re.compile("|".join(re.escape(b) for b in _BANNED), re.IGNORECASE)
+
+
+def _dumps(obj: Any) -> str:
+    # orjson writes UTF-8 directly, matching json.dumps(ensure_ascii=False)
+    return orjson.dumps(obj).decode()
+
+
+# Payload schemas, compiled by msgspec into native validators.
+def _expect_int(value: Any, expected: int) -> int:
+    # The old dict validators compared int(value), so "401" and 401.0 passed.
+    if int(value) != expected:
+        raise ValueError(f"expected {expected}, got {value!r}")
+    return expected
+
+
+class _LoginError(msgspec.Struct):
+    code: Union[int, float, str]
+    message: str
+    request_id: str
+    retry_after: Union[bool, int, float]  # bool passed the old isinstance(int) check
+
+    def __post_init__(self):
+        self.code = _expect_int(self.code, 401)
+
+
+class _LoginBody(msgspec.Struct):
+    error: _LoginError
+
+
+class _LoginResponse(msgspec.Struct):
+    content_type: Literal["application/json"]
+    status_code: Union[int, float, str]
+    body: _LoginBody
+
+    def __post_init__(self):
+        self.status_code = _expect_int(self.status_code, 401)
+
+
+class _AdminResponse(msgspec.Struct):
+    content_type: Literal["text/html"]
+    status_code: Union[int, float, str]
+    body: str
+
+    def __post_init__(self):
+        self.status_code = _expect_int(self.status_code, 403)
+
+
+_RiskScore = Union[bool, Annotated[int, msgspec.Meta(ge=0, le=100)]]
+
+
+class _LoginPayload(msgspec.Struct):
+    fake_response: _LoginResponse
+    fake_creds: dict
+    fake_logs: list
+    suggested_endpoints: list
+    risk_score: _RiskScore
+
+
+class _AdminPayload(msgspec.Struct):
+    fake_response: _AdminResponse
+    fake_creds: dict
+    fake_logs: list
+    suggested_endpoints: list
+    risk_score: _RiskScore
+
+
+# Parse and validate in one pass over the response bytes.
+_LOGIN_DECODER = msgspec.json.Decoder(_LoginPayload)
+_ADMIN_DECODER = msgspec.json.Decoder(_AdminPayload)
+
+
+def _decode_payload(text: str, decoder: msgspec.json.Decoder) -> Optional[Dict[str, Any]]:
+    """
+    Strict parse+validate of the LLM response into plain builtins; falls back
+    to the first {...} span when the model wrapped its JSON in prose. Keys
+    outside the schema are dropped. None if invalid.
+    """
     if not text:
         return None
     text = text.strip()
 
-    # Strict attempt
     try:
-        return json.loads(text)
-    except Exception:
+        return msgspec.to_builtins(decoder.decode(text))
+    except msgspec.ValidationError:
+        return None
+    except msgspec.DecodeError:
         pass
 
-    # Best-effort: extract first JSON object (still validated after)
-    m = re.search(r"\{.*\}", text, flags=re.DOTALL)
+    # Best-effort: extract first JSON object (still validated)
+    m = _JSON_OBJ_RE.search(text)
     if not m:
         return None
     try:
-        return json.loads(m.group(0))
-    except Exception:
+        return msgspec.to_builtins(decoder.decode(m.group(0)))
+    except msgspec.DecodeError:
         return None
 
 
-def _has_required_keys(payload: Dict[str, Any]) -> bool:
-    required = {"fake_response", "fake_creds", "fake_logs", "suggested_endpoints", "risk_score"}
-    return required.issubset(payload.keys())
-
-
-def _is_valid_login_payload(payload: Dict[str, Any]) -> bool:
-    if not _has_required_keys(payload):
-        return False
-
-    fr = payload.get("fake_response")
-    if not isinstance(fr, dict):
-        return False
-    if fr.get("content_type") != "application/json":
-        return False
-    if int(fr.get("status_code", 0)) != 401:
-        return False
-    if not isinstance(fr.get("body"), dict):
-        return False
-
-    err = fr["body"].get("error")
-    if not isinstance(err, dict):
-        return False
-    if int(err.get("code", 0)) != 401:
-        return False
-    if not isinstance(err.get("message"), str):
-        return False
-    if not isinstance(err.get("request_id"), str):
-        return False
-    if not isinstance(err.get("retry_after"), (int, float)):
-        return False
-
-    if not isinstance(payload.get("fake_creds"), dict):
-        return False
-    if not isinstance(payload.get("fake_logs"), list):
-        return False
-    if not isinstance(payload.get("suggested_endpoints"), list):
-        return False
-    if not isinstance(payload.get("risk_score"), int):
-        return False
-
-    rs = payload["risk_score"]
-    return 0 <= rs <= 100
-
-
-def _is_valid_admin_payload(payload: Dict[str, Any]) -> bool:
-    if not _has_required_keys(payload):
-        return False
-
-    fr = payload.get("fake_response")
-    if not isinstance(fr, dict):
-        return False
-    if fr.get("content_type") != "text/html":
-        return False
-    if int(fr.get("status_code", 0)) != 403:
-        return False
-    if not isinstance(fr.get("body"), str):
-        return False
-
-    if not isinstance(payload.get("fake_creds"), dict):
-        return False
-    if not isinstance(payload.get("fake_logs"), list):
-        return False
-    if not isinstance(payload.get("suggested_endpoints"), list):
-        return False
-    if not isinstance(payload.get("risk_score"), int):
-        return False
-
-    rs = payload["risk_score"]
-    return 0 <= rs <= 100
-
-
 def _safety_guard(payload: Dict[str, Any]) -> bool:
     """
     Hard guard to reduce chance of accidentally emitting something that resembles secrets.
     (Still keep this conservative; it’s a honeypot.)
     """
-    dumped = json.dumps(payload, ensure_ascii=False).lower()
-    banned = [
-        "begin private key",
-        "-----begin",
-        "sk-",
-        "azure_openai_api_key",
-        "authorization: bearer ",
-    ]
-    return not any(b in dumped for b in banned)
+    return _BANNED_RE.search(_dumps(payload)) is None
 
 
 # ----------------------------
 # Risk scoring (deterministic)
 # ----------------------------
 
-def _compute_risk(current_request: dict, recent_events: list, base: int = 45) -> int:
-    path = (current_request.get("path") or "").lower()
-    method = (current_request.get("method") or "GET").upper()
+_HIGH_VALUE_PATHS = frozenset({"/config", "/backup", "/.env", "/secrets"})
+# Suspicious usernames (avoid noisy "sa" substring matches)
+_SUSPICIOUS_TOKENS = ("admin", "root", "test", "guest", "sys")
+_SERVICE_USERNAMES = frozenset({"sa", "svc", "service", "svc_auth"})
+
+
+def _recent_hits(current_request: dict, recent_events: list) -> Tuple[int, int]:
+    """
+    (login_hits, admin_hits) over the last 20 prior events. Explicit
+    recent_events are counted in one pass; otherwise the session's counters
+    kept by push_event are read (app.py pushes each request only after its
+    route has run, so the current one is never included).
+    """
+    if recent_events:
+        paths = [str(e.get("path", "")).lower() for e in recent_events[-20:]]
+        return paths.count("/login"), paths.count("/admin")
+
+    with _SESSION_LOCK:
+        sess = _SESSION.get(_session_id(current_request))
+        hits = sess.get("hits") if sess else None
+        if not hits:
+            return 0, 0
+        return hits["/login"], hits["/admin"]
+
+
+def _request_risk(current_request: dict, path: str, method: str, login_hits: int, base: int) -> int:
+    """Unclamped login-style risk; shared by both scorers."""
     body = current_request.get("body") or {}
 
     username = ""
@@ -310,48 +638,48 @@ def _compute_risk(current_request: dict, recent_events: list, base: int = 45) ->
     # High-value paths
     if path == "/admin":
         risk += 40
-    if path in ["/config", "/backup", "/.env", "/secrets"]:
+    if path in _HIGH_VALUE_PATHS:
         risk += 30
 
     # Login behavior
     if path == "/login" and method == "POST":
         risk += 15
 
-    # Suspicious usernames (avoid noisy "sa" substring matches)
-    suspicious_tokens = ["admin", "root", "test", "guest", "sys"]
-    if any(tok in username for tok in suspicious_tokens):
+    if any(tok in username for tok in _SUSPICIOUS_TOKENS):
         risk += 25
-    if username in {"sa", "svc", "service", "svc_auth"} or username.startswith("sa@"):
+    if username in _SERVICE_USERNAMES or username.startswith("sa@"):
         risk += 25
 
     # Brute force hint (simple)
-    login_hits = sum(
-        1 for e in (recent_events or [])[-20:]
-        if str(e.get("path", "")).lower() == "/login"
-    )
     if login_hits >= 5:
         risk += 20
     if login_hits >= 10:
         risk += 20
 
+    return risk
+
+
+def _compute_risk(current_request: dict, recent_events: list, base: int = 45) -> int:
+    path = (current_request.get("path") or "").lower()
+    method = (current_request.get("method") or "GET").upper()
+    login_hits, _ = _recent_hits(current_request, recent_events)
+
+    risk = _request_risk(current_request, path, method, login_hits, base)
     return max(0, min(100, int(risk)))
 
 
 def _compute_admin_risk(current_request: dict, recent_events: list, base: int = 60) -> int:
-    risk = _compute_risk(current_request, recent_events, base=base)
-
     path = (current_request.get("path") or "").lower()
     method = (current_request.get("method") or "GET").upper()
+    login_hits, admin_hits = _recent_hits(current_request, recent_events)
+
+    risk = _request_risk(current_request, path, method, login_hits, base)
 
     if path == "/admin":
         risk += 20
     if path == "/admin" and method == "POST":
         risk += 15
 
-    admin_hits = sum(
-        1 for e in (recent_events or [])[-20:]
-        if str(e.get("path", "")).lower() == "/admin"
-    )
     if admin_hits >= 3:
         risk += 15
     if admin_hits >= 6:
@@ -364,13 +692,26 @@ def _compute_admin_risk(current_request: dict, recent_events: list, base: int =
 # Fallback responders
 # ----------------------------
 
+# (epoch second, formatted timestamp) of the last fallback
+_ts_cache: Tuple[int, str] = (0, "")
+
+
+def _now_iso() -> str:
+    """Second-resolution UTC timestamp, formatted at most once per second."""
+    global _ts_cache
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        _ts_cache = (now, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)))
+    return _ts_cache[1]
+
+
 def _fallback_login(
     env: Dict[str, Any],
     req: Dict[str, Any],
     recent_events: Optional[List[Dict[str, Any]]] = None
 ) -> Dict[str, Any]:
-    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    req_id = f"req_{uuid.uuid4().hex[:10]}"
+    now = _now_iso()
+    req_id = "req_" + secrets.token_hex(5)
 
     body = req.get("body") or {}
     username = ""
@@ -387,7 +728,7 @@ def _fallback_login(
             "retry_after": 5,
         },
         "tenant": env.get("tenant", "tnt_0000"),
-        "trace": {"correlation_id": f"corr_{uuid.uuid4().hex[:8]}"},
+        "trace": {"correlation_id": "corr_" + secrets.token_hex(4)},
     }
 
     return {
@@ -395,7 +736,7 @@ def _fallback_login(
         "fake_creds": {
             "username": "svc_auth",
             "password_hint": "******** (rotated)",
-            "token_sample": "tok_" + uuid.uuid4().hex[:18],
+            "token_sample": "tok_" + secrets.token_hex(9),
             "notes": f'Fake service account pattern for {env.get("org_name","Org")}.',
         },
         "fake_logs": [
@@ -408,61 +749,71 @@ def _fallback_login(
     }
 
 
-def _fallback_admin(
-    env: Dict[str, Any],
-    req: Dict[str, Any],
-    recent_events: Optional[List[Dict[str, Any]]] = None
-) -> Dict[str, Any]:
-    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    req_id = f"req_{uuid.uuid4().hex[:10]}"
-
-    risk = _compute_admin_risk(req, recent_events or [], base=60)
-
-    org = env.get("org_name", "Enterprise")
-    tenant = env.get("tenant", "tnt_0000")
-
-    html_body = f"""
+# Static admin page; org/tenant are filled once per profile, request id and
+# timestamp per call.
+_ADMIN_HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
 <head>
   <meta charset="utf-8" />
-  <title>{org} Admin Portal</title>
+  <title>@@ORG@@ Admin Portal</title>
   <style>
-    body {{ font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; background:#f5f6f8; }}
-    .card {{
+    body { font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; background:#f5f6f8; }
+    .card {
       max-width:560px; margin:80px auto; background:#fff;
       padding:32px; border-radius:8px;
       box-shadow:0 6px 22px rgba(0,0,0,.10);
       border:1px solid rgba(0,0,0,.06);
-    }}
-    h1 {{ margin:0 0 10px 0; color:#b00020; font-size:22px; }}
-    p {{ color:#444; line-height:1.45; }}
-    .meta {{ font-size:13px; color:#777; margin-top:18px; }}
-    .badge {{ display:inline-block; padding:3px 8px; border-radius:999px; font-size:12px; background:#eef1f5; color:#333; }}
+    }
+    h1 { margin:0 0 10px 0; color:#b00020; font-size:22px; }
+    p { color:#444; line-height:1.45; }
+    .meta { font-size:13px; color:#777; margin-top:18px; }
+    .badge { display:inline-block; padding:3px 8px; border-radius:999px; font-size:12px; background:#eef1f5; color:#333; }
   </style>
 </head>
 <body>
   <div class="card">
-    <div class="badge">{org} • Administrative Console</div>
+    <div class="badge">@@ORG@@ • Administrative Console</div>
     <h1>Access Denied</h1>
     <p>You do not have sufficient privileges to access this resource.</p>
     <p>This request has been recorded in audit logs and may be reviewed by Security Operations.</p>
     <div class="meta">
-      Request ID: {req_id}<br/>
-      Tenant: {tenant}<br/>
-      Timestamp: {now}
+      Request ID: @@REQ_ID@@<br/>
+      Tenant: @@TENANT@@<br/>
+      Timestamp: @@NOW@@
     </div>
   </div>
 </body>
 </html>
 """.strip()
 
+
+@lru_cache(maxsize=256)
+def _admin_html(org: str, tenant: str) -> str:
+    return _ADMIN_HTML_TEMPLATE.replace("@@ORG@@", org).replace("@@TENANT@@", tenant)
+
+
+def _fallback_admin(
+    env: Dict[str, Any],
+    req: Dict[str, Any],
+    recent_events: Optional[List[Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    now = _now_iso()
+    req_id = "req_" + secrets.token_hex(5)
+
+    risk = _compute_admin_risk(req, recent_events or [], base=60)
+
+    org = env.get("org_name", "Enterprise")
+    tenant = env.get("tenant", "tnt_0000")
+
+    html_body = _admin_html(org, tenant).replace("@@REQ_ID@@", req_id).replace("@@NOW@@", now)
+
     return {
         "fake_response": {"content_type": "text/html", "status_code": 403, "body": html_body},
         "fake_creds": {
             "username": "admin_ops",
             "password_hint": "******** (MFA enforced)",
-            "token_sample": "adm_tok_" + uuid.uuid4().hex[:14],
+            "token_sample": "adm_tok_" + secrets.token_hex(7),
             "notes": f"Administrative service account pattern for {org}.",
         },
         "fake_logs": [
@@ -476,80 +827,276 @@ def _fallback_admin(
 
 
 # ----------------------------
-# Public API
+# Prompt assembly
 # ----------------------------
 
-def generate_deception(
+_SLOTS = ("env_profile_json", "recent_events_json", "current_request_json")
+
+
+def _split_prompt(template: str) -> Tuple[str, str, str, str]:
+    """Literal pieces around the three context slots, with {{ }} already unescaped."""
+    marked = template.format(**{k: f"\x00{k}\x00" for k in _SLOTS})
+    p0, rest = marked.split(f"\x00{_SLOTS[0]}\x00")
+    p1, rest = rest.split(f"\x00{_SLOTS[1]}\x00")
+    p2, p3 = rest.split(f"\x00{_SLOTS[2]}\x00")
+    return p0, p1, p2, p3
+
+
+_LOGIN_PARTS = _split_prompt(LOGIN_PROMPT)
+_ADMIN_PARTS = _split_prompt(ADMIN_PROMPT)
+
+
+def _build_prompt(parts: Tuple[str, str, str, str], env_json: str, recent_json: str, cur_json: str) -> str:
+    # Same text as template.format(...), without re-parsing the format string.
+    return "".join((parts[0], env_json, parts[1], recent_json, parts[2], cur_json, parts[3]))
+
+
+# ----------------------------
+# Route table
+# ----------------------------
+
+# Generation time scales with output length; these cover the expected payloads.
+_MAX_TOKENS_LOGIN = int(os.getenv("DECEPTION_MAX_TOKENS_LOGIN", "256"))
+_MAX_TOKENS_ADMIN = int(os.getenv("DECEPTION_MAX_TOKENS_ADMIN", "512"))
+
+# (prompt parts, decoder, risk fn, risk base, fallback, deadline, max tokens)
+_Route = Tuple[
+    Tuple[str, str, str, str],
+    msgspec.json.Decoder,
+    Callable[..., int],
+    int,
+    Callable[..., Dict[str, Any]],
+    float,
+    int,
+]
+
+_ROUTES: Dict[str, _Route] = {
+    "/admin": (_ADMIN_PARTS, _ADMIN_DECODER, _compute_admin_risk, 60, _fallback_admin, _DEADLINE_ADMIN, _MAX_TOKENS_ADMIN),
+    "/login": (_LOGIN_PARTS, _LOGIN_DECODER, _compute_risk, 45, _fallback_login, _DEADLINE_LOGIN, _MAX_TOKENS_LOGIN),
+}
+
+
+def _prepare(
     recent_events: List[Dict[str, Any]],
     current_request: Dict[str, Any]
-) -> Dict[str, Any]:
+) -> Tuple[Optional[_Route], Dict[str, Any], Optional[str]]:
+    """Returns (route, env, prompt); prompt is None when no LLM call is needed."""
     sid = _session_id(current_request)
-    env = _get_env_profile(sid)
+    env, env_json = _session_profile(sid)
 
     path = str(current_request.get("path", "")).lower()
+    route = _ROUTES.get(path)
+    if route is None or not _get_llms():
+        return route, env, None
+
+    # Explicit recent_events win; otherwise use what push_event recorded.
+    if recent_events:
+        recent_json = _dumps(recent_events[-RECENT_EVENTS_MAX:])
+    else:
+        recent_json = _recent_events_json(sid)
+
+    prompt = _build_prompt(
+        route[0],
+        env_json,
+        recent_json,
+        _dumps(_prompt_request(current_request)),
+    )
+    return route, env, prompt
 
-    # Admin panel route
-    if path == "/admin":
-        llm = _get_llm()
-        if llm is None:
-            return _fallback_admin(env, current_request, recent_events)
 
-        prompt = ADMIN_PROMPT.format(
-            env_profile_json=json.dumps(env, ensure_ascii=False),
-            recent_events_json=json.dumps((recent_events or [])[-20:], ensure_ascii=False),
-            current_request_json=json.dumps(current_request, ensure_ascii=False),
-        )
+def _finish(
+    route: Optional[_Route],
+    env: Dict[str, Any],
+    current_request: Dict[str, Any],
+    recent_events: List[Dict[str, Any]],
+    resp: Any,
+) -> Tuple[Dict[str, Any], bool]:
+    """(result, from_llm); from_llm is False whenever the fallback was served."""
+    # Default: keep behavior similar to your original (login-style response for unknown paths)
+    fallback = route[4] if route else _fallback_login
+    if route is None or resp is None or isinstance(resp, BaseException):
+        return fallback(env, current_request, recent_events), False
 
-        try:
-            resp = llm.invoke(prompt)
-            text = resp.content if hasattr(resp, "content") else str(resp)
+    _, decoder, compute_risk, base, _, _, _ = route
+    try:
+        text = resp.content if hasattr(resp, "content") else str(resp)
 
-            payload = _parse_strict_json(text)
-            if not isinstance(payload, dict):
-                return _fallback_admin(env, current_request, recent_events)
+        payload = _decode_payload(text, decoder)
+        if payload is None:
+            return fallback(env, current_request, recent_events), False
 
-            if not _is_valid_admin_payload(payload):
-                return _fallback_admin(env, current_request, recent_events)
+        if not _safety_guard(payload):
+            return fallback(env, current_request, recent_events), False
 
-            if not _safety_guard(payload):
-                return _fallback_admin(env, current_request, recent_events)
+        # Enforce deterministic risk score (don’t trust LLM for scoring)
+        payload["risk_score"] = compute_risk(current_request, recent_events, base=base)
+        return payload, True
+    except Exception:
+        return fallback(env, current_request, recent_events), False
 
-            # Enforce deterministic risk score (don’t trust LLM for scoring)
-            payload["risk_score"] = _compute_admin_risk(current_request, recent_events, base=60)
-            return payload
-        except Exception:
-            return _fallback_admin(env, current_request, recent_events)
 
-    # Login route
-    if path == "/login":
-        llm = _get_llm()
-        if llm is None:
-            return _fallback_login(env, current_request, recent_events)
+async def _ainvoke_with_timeout(llm: BaseChatModel, prompt: str, timeout: float, max_tokens: int) -> Any:
+    return await asyncio.wait_for(llm.ainvoke(prompt, max_tokens=max_tokens), timeout=timeout)
 
-        prompt = LOGIN_PROMPT.format(
-            env_profile_json=json.dumps(env, ensure_ascii=False),
-            recent_events_json=json.dumps((recent_events or [])[-20:], ensure_ascii=False),
-            current_request_json=json.dumps(current_request, ensure_ascii=False),
-        )
 
-        try:
-            resp = llm.invoke(prompt)
-            text = resp.content if hasattr(resp, "content") else str(resp)
+# ----------------------------
+# Re-serving a generated result
+# ----------------------------
+
+# Ids the prompts and fallbacks use (req_…, corr_…, adm_tok_…) and ISO-ish
+# timestamps; both are per request, so a reused result gets fresh ones.
+# Prefixes may follow "_" (so \b won't do) but not a letter or digit.
+_ID_RE = re.compile(r"(?<![A-Za-z0-9])(req|corr|trace|sess|evt|adm_tok|tok)_([0-9A-Za-z]+)")
+_TIMESTAMP_RE = re.compile(
+    r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?"
+)
+_PROFILE_KEYS = ("org_name", "domain", "tenant", "build_id", "region")
+
+
+def _fresh_id(m: "re.Match[str]", seen: Dict[str, str]) -> str:
+    old = m.group(0)
+    new = seen.get(old)
+    if new is None:
+        n = len(m.group(2))
+        new = seen[old] = f"{m.group(1)}_{secrets.token_hex((n + 1) // 2)[:n]}"
+    return new
+
+
+def personalize_deception(
+    result: Dict[str, Any],
+    source_request: Dict[str, Any],
+    current_request: Dict[str, Any],
+) -> Dict[str, Any]:
+    """
+    Deep copy of a result generated for source_request, made fit to serve to
+    current_request: the source session's env profile values are swapped for
+    the current session's, and request ids and timestamps are regenerated
+    (consistently, so an id repeated across body and logs still matches).
+    """
+    src_env, _ = _session_profile(_session_id(source_request))
+    cur_env, _ = _session_profile(_session_id(current_request))
+    swaps = {
+        str(src_env[k]): str(cur_env[k])
+        for k in _PROFILE_KEYS
+        if src_env.get(k) and src_env.get(k) != cur_env.get(k)
+    }
+    swap_re = (
+        re.compile("|".join(re.escape(v) for v in sorted(swaps, key=len, reverse=True)))
+        if swaps else None
+    )
+    seen: Dict[str, str] = {}
+    now = _now_iso()
 
-            payload = _parse_strict_json(text)
-            if not isinstance(payload, dict):
-                return _fallback_login(env, current_request, recent_events)
+    def fix(value: Any) -> Any:
+        if isinstance(value, str):
+            if swap_re is not None:
+                value = swap_re.sub(lambda m: swaps[m.group(0)], value)
+            value = _ID_RE.sub(lambda m: _fresh_id(m, seen), value)
+            return _TIMESTAMP_RE.sub(now, value)
+        if isinstance(value, dict):
+            return {k: fix(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [fix(v) for v in value]
+        return value
 
-            if not _is_valid_login_payload(payload):
-                return _fallback_login(env, current_request, recent_events)
+    return fix(result)
 
-            if not _safety_guard(payload):
-                return _fallback_login(env, current_request, recent_events)
 
-            payload["risk_score"] = _compute_risk(current_request, recent_events, base=45)
-            return payload
-        except Exception:
-            return _fallback_login(env, current_request, recent_events)
+# ----------------------------
+# Public API
+# ----------------------------
 
-    # Default: keep behavior similar to your original (login-style response for unknown paths)
-    return _fallback_login(env, current_request, recent_events)
+def generate_deception_sourced(
+    recent_events: List[Dict[str, Any]],
+    current_request: Dict[str, Any]
+) -> Tuple[Dict[str, Any], bool]:
+    """generate_deception, plus whether the result came from the LLM (False for fallbacks)."""
+    route, env, prompt = _prepare(recent_events, current_request)
+
+    resp = None
+    if prompt is not None:
+        resp = _invoke_with_fallback(prompt, route[5], route[6])
+
+    return _finish(route, env, current_request, recent_events, resp)
+
+
+def generate_deception(
+    recent_events: List[Dict[str, Any]],
+    current_request: Dict[str, Any]
+) -> Dict[str, Any]:
+    return generate_deception_sourced(recent_events, current_request)[0]
+
+
+def compute_risk(
+    current_request: Dict[str, Any],
+    recent_events: Optional[List[Dict[str, Any]]] = None
+) -> int:
+    """The deterministic risk score generate_deception would attach to this request."""
+    route = _ROUTES.get(str(current_request.get("path", "")).lower())
+    if route is None:
+        return _compute_risk(current_request, recent_events or [], base=45)
+    return route[2](current_request, recent_events or [], base=route[3])
+
+
+async def generate_deception_async_sourced(
+    recent_events: List[Dict[str, Any]],
+    current_request: Dict[str, Any]
+) -> Tuple[Dict[str, Any], bool]:
+    """Async generate_deception_sourced."""
+    route, env, prompt = _prepare(recent_events, current_request)
+
+    resp = None
+    if prompt is not None:
+        resp = await _ainvoke_with_fallback(prompt, route[5], route[6])
+
+    return _finish(route, env, current_request, recent_events, resp)
+
+
+async def generate_deception_async(
+    recent_events: List[Dict[str, Any]],
+    current_request: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Same contract as generate_deception, without blocking the event loop on Azure."""
+    return (await generate_deception_async_sourced(recent_events, current_request))[0]
+
+
+async def generate_deception_many(
+    requests: List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]
+) -> List[Dict[str, Any]]:
+    """
+    Batch entrypoint: requests is a list of (recent_events, current_request).
+    LLM-backed requests go out together through abatch (bounded by
+    DECEPTION_BATCH_CONCURRENCY); the rest are answered by their fallbacks.
+    Results are returned in input order.
+    """
+    prepared = [_prepare(events, req) for events, req in requests]
+    pending = [i for i, (_, _, prompt) in enumerate(prepared) if prompt is not None]
+
+    responses: List[Any] = [None] * len(prepared)
+    available = _available_llms(_loop_llms())
+    if pending and available:
+        rank, llm = available[0]
+        try:
+            # abatch has no per-item deadline, so the whole batch gets the longest
+            # route deadline among its requests and falls back together past it.
+            results = await asyncio.wait_for(
+                llm.abatch(
+                    [prepared[i][2] for i in pending],
+                    config={"max_concurrency": LLM_BATCH_CONCURRENCY},
+                    return_exceptions=True,
+                    max_tokens=max(prepared[i][0][6] for i in pending),
+                ),
+                timeout=max(prepared[i][0][5] for i in pending),
+            )
+        except asyncio.TimeoutError:
+            results = [None] * len(pending)
+            _FAILED_AT[rank] = time.monotonic()
+        if all(isinstance(r, BaseException) for r in results):
+            _FAILED_AT[rank] = time.monotonic()
+        for i, r in zip(pending, results):
+            responses[i] = r
+
+    return [
+        _finish(route, env, req, events, resp)[0]
+        for (route, env, _), (events, req), resp in zip(prepared, requests, responses)
+    ]
@@ -1,12 +1,90 @@
 # deception_stub.py
-from typing import Any, Dict
-from deception_engine import generate_deception as brain_generate_deception
+import copy
+import os
+import re
+import threading
+from typing import Any, Dict, Optional, Tuple
 
-def generate_deception(context: Dict[str, Any]) -> Dict[str, Any]:
-    path = context.get("path", "/")
+from cachetools import TTLCache
+
+from deception_engine import (
+    compute_risk as brain_compute_risk,
+    generate_deception_async_sourced as brain_generate_deception_async,
+    generate_deception_sourced as brain_generate_deception,
+    personalize_deception,
+)
+
+_DECEPTION_IDS = {
+    "/login": "dec-login-001",
+    "/admin": "dec-admin-001",
+}
+_DEFAULT_DECEPTION_ID = "dec-generic-001"
+
+_RESPONSE_TYPES = {
+    "application/json": "json",
+    "text/html": "html",
+}
+
+# Scanners re-probe the same URLs with the same tools, so LLM-generated
+# responses are reused per (path, method, UA class, template) for a while.
+# IP is deliberately not part of the key. Fallbacks are never cached. A hit
+# is re-personalized for the requesting session (env profile, ids,
+# timestamps) and gets its own risk_score, since that depends on the body.
+_RESPONSE_CACHE: TTLCache = TTLCache(
+    maxsize=int(os.getenv("DECEPTION_RESPONSE_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("DECEPTION_RESPONSE_CACHE_TTL", "600")),
+)
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+_UA_BUCKETS = (
+    ("sqlmap", re.compile(r"sqlmap", re.IGNORECASE)),
+    ("curl", re.compile(r"^curl/", re.IGNORECASE)),
+    ("python-requests", re.compile(r"python-requests|python-urllib|aiohttp|httpx", re.IGNORECASE)),
+    ("browser", re.compile(r"^Mozilla/")),
+)
+
+
+def _ua_bucket(user_agent: Optional[str]) -> str:
+    ua = user_agent or ""
+    for name, pattern in _UA_BUCKETS:
+        if pattern.search(ua):
+            return name
+    return "other"
+
+
+def _cache_key(context: Dict[str, Any]) -> Tuple[str, str, str, str]:
+    path = str(context.get("path", "/")).lower()
+    return (
+        path,
+        str(context.get("method") or "GET").upper(),
+        _ua_bucket(context.get("user_agent")),
+        _DECEPTION_IDS.get(path, _DEFAULT_DECEPTION_ID),
+    )
+
+
+def _cached(context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    with _RESPONSE_CACHE_LOCK:
+        hit = _RESPONSE_CACHE.get(_cache_key(context))
+    if hit is None:
+        return None
+    result, source_request = hit
+    current_request = _current_request(context)
+    fresh = personalize_deception(result, source_request, current_request)
+    fresh["risk_score"] = brain_compute_risk(current_request)
+    return fresh
 
-    current_request = {
-        "path": path,
+
+def _store(context: Dict[str, Any], result: Dict[str, Any], from_llm: bool) -> Dict[str, Any]:
+    if from_llm:
+        entry = (copy.deepcopy(result), _current_request(context))
+        with _RESPONSE_CACHE_LOCK:
+            _RESPONSE_CACHE[_cache_key(context)] = entry
+    return result
+
+
+def _current_request(context: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "path": context.get("path", "/"),
         "method": context.get("method"),
         "ip": context.get("ip"),
         "user_agent": context.get("user_agent"),
@@ -14,30 +92,16 @@ def generate_deception(context: Dict[str, Any]) -> Dict[str, Any]:
         "session_id": context.get("session_id"),
     }
 
-    result = brain_generate_deception(recent_events=[], current_request=current_request)
 
+def _to_stub_result(path: str, result: Dict[str, Any]) -> Dict[str, Any]:
     fake_response = result["fake_response"]
     content_type = fake_response.get("content_type", "application/json")
 
-    if content_type == "application/json":
-        response_type = "json"
-    elif content_type == "text/html":
-        response_type = "html"
-    else:
-        response_type = "text"
-
-    if path == "/login":
-        deception_id = "dec-login-001"
-    elif path == "/admin":
-        deception_id = "dec-admin-001"
-    else:
-        deception_id = "dec-generic-001"
-
     return {
-        "response_type": response_type,
+        "response_type": _RESPONSE_TYPES.get(content_type, "text"),
         "content": fake_response["body"],
         "status_code": int(fake_response["status_code"]),
-        "deception_id": deception_id,
+        "deception_id": _DECEPTION_IDS.get(path, _DEFAULT_DECEPTION_ID),
 
         # internal fields for dashboard/alerts
         "risk_score": result["risk_score"],
@@ -45,3 +109,19 @@ def generate_deception(context: Dict[str, Any]) -> Dict[str, Any]:
         "suggested_endpoints": result["suggested_endpoints"],
         "fake_creds": result["fake_creds"],
     }
+
+
+def generate_deception(context: Dict[str, Any]) -> Dict[str, Any]:
+    cached = _cached(context)
+    if cached is not None:
+        return cached
+    result, from_llm = brain_generate_deception(recent_events=[], current_request=_current_request(context))
+    return _store(context, _to_stub_result(context.get("path", "/"), result), from_llm)
+
+
+async def generate_deception_async(context: Dict[str, Any]) -> Dict[str, Any]:
+    cached = _cached(context)
+    if cached is not None:
+        return cached
+    result, from_llm = await brain_generate_deception_async(recent_events=[], current_request=_current_request(context))
+    return _store(context, _to_stub_result(context.get("path", "/"), result), from_llm)
@@ -1,21 +1,50 @@
 # detection/analytics.py
 from __future__ import annotations
-from typing import Dict, List
-from collections import Counter
+from datetime import datetime, timezone
+from heapq import nlargest
+from operator import itemgetter
+from typing import Dict, List, Optional, Sequence
+
+from .scoring import ALL_TAGS
+
+_by_count = itemgetter(1)
+
+
+def _iso(ts: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else None
+
+
+def top_tags(counts: Sequence[int], k: int) -> List[str]:
+    """The k most frequent tags in a TAG_INDEX-ordered count array, without sorting it."""
+    return [ALL_TAGS[i] for i, n in nlargest(k, enumerate(counts), key=_by_count) if n]
+
+
+def ip_top_tags(st, k: int) -> List[str]:
+    """top_tags(st.tag_counts, k), recomputed only after the counts have changed."""
+    if st.top_tags_cache_version != st.tags_version:
+        st.top_tags_cache.clear()
+        st.top_tags_cache_version = st.tags_version
+    cached = st.top_tags_cache.get(k)
+    if cached is None:
+        cached = st.top_tags_cache[k] = top_tags(st.tag_counts, k)
+    return list(cached)
+
 
 def leaderboard(state, limit: int = 20) -> List[Dict]:
     rows = []
-    for ip, st in state.by_ip.items():
-        rows.append({
-            "ip": ip,
-            "score": st.score,
-            "severity": severity(st.score),
-            "last_seen": st.last_seen.isoformat() if st.last_seen else None,
-            "attack_type_guess": st.attack_type_guess,
-            "top_tags": [t for t, _ in st.tags.most_common(5)],
-        })
-    rows.sort(key=lambda r: r["score"], reverse=True)
-    return rows[:limit]
+    # Under the state lock so prune_old can't drop an IP between the two reads.
+    with state.lock:
+        for score, ip in state.top_by_score(limit):
+            st = state.by_ip[ip]
+            rows.append({
+                "ip": ip,
+                "score": score,
+                "severity": severity(score),
+                "last_seen": _iso(st.last_seen),
+                "attack_type_guess": st.attack_type_guess,
+                "top_tags": ip_top_tags(st, 5),
+            })
+    return rows
 
 def ip_summary(state, ip: str) -> Dict:
     st = state.by_ip.get(ip)
@@ -25,9 +54,9 @@ def ip_summary(state, ip: str) -> Dict:
         "ip": ip,
         "score": st.score,
         "severity": severity(st.score),
-        "last_seen": st.last_seen.isoformat() if st.last_seen else None,
+        "last_seen": _iso(st.last_seen),
         "attack_type_guess": st.attack_type_guess,
-        "top_tags": [t for t, _ in st.tags.most_common(10)],
+        "top_tags": ip_top_tags(st, 10),
         "timeline": list(st.timeline),
     }
 
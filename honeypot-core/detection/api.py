@@ -4,8 +4,14 @@ API endpoints for Person 4's dashboard.
 Register this blueprint in app.py.
 """
 from __future__ import annotations
-from flask import Blueprint, jsonify, request
-from typing import TYPE_CHECKING
+import os
+from pathlib import Path
+from flask import Blueprint, Response, request
+from typing import TYPE_CHECKING, Any, List
+
+import orjson
+
+from . import sentinel
 
 if TYPE_CHECKING:
     from .pipeline import DetectionPipeline
@@ -21,13 +27,46 @@ def init_api(pipeline: "DetectionPipeline"):
     _pipeline = pipeline
 
 
+def _ojsonify(obj: Any) -> Response:
+    """jsonify() replacement backed by orjson."""
+    return Response(
+        orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_DATACLASS),
+        mimetype="application/json",
+    )
+
+
+def _tail_lines(path: Path, limit: int, block: int = 8192) -> List[bytes]:
+    """
+    Last `limit` non-empty lines of `path`, read backwards from the end like
+    tail -n. As with lines[-limit:], limit <= 0 reads the whole file and
+    drops the first -limit lines.
+    """
+    if limit <= 0:
+        data = path.read_bytes()
+    else:
+        chunks: List[bytes] = []
+        newlines = 0
+        with path.open("rb") as f:
+            pos = f.seek(0, os.SEEK_END)
+            # One newline more than needed guarantees the oldest kept line is whole.
+            while pos > 0 and newlines <= limit:
+                step = min(block, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step)
+                newlines += chunk.count(b"\n")
+                chunks.append(chunk)
+        data = b"".join(reversed(chunks))
+    return [line for line in data.splitlines() if line.strip()][-limit:]
+
+
 @bp.route("/leaderboard")
 def leaderboard():
     """Top attackers by score."""
     from .analytics import leaderboard as get_leaderboard
     limit = request.args.get("limit", 20, type=int)
     data = get_leaderboard(_pipeline.state, limit=limit)
-    return jsonify({"attackers": data, "total": len(_pipeline.state.by_ip)})
+    return _ojsonify({"attackers": data, "total": len(_pipeline.state.by_ip)})
 
 
 @bp.route("/ip/<ip>")
@@ -35,7 +74,7 @@ def ip_detail(ip: str):
     """Detailed view for a single IP."""
     from .analytics import ip_summary
     data = ip_summary(_pipeline.state, ip)
-    return jsonify(data)
+    return _ojsonify(data)
 
 
 @bp.route("/timeline/<ip>")
@@ -43,13 +82,13 @@ def ip_timeline(ip: str):
     """Full event timeline for an IP (for dashboard drill-down)."""
     st = _pipeline.state.by_ip.get(ip)
     if not st:
-        return jsonify({"ip": ip, "events": [], "error": "IP not found"}), 404
+        return _ojsonify({"ip": ip, "events": [], "error": "IP not found"}), 404
     
-    # Convert deque to list, limit to last N events
+    # Last N events only (as with a [-N:] slice, N <= 0 drops the first -N)
     limit = request.args.get("limit", 100, type=int)
-    events = list(st.timeline)[-limit:]
+    events = st.tail(limit)
     
-    return jsonify({
+    return _ojsonify({
         "ip": ip,
         "score": st.score,
         "attack_type_guess": st.attack_type_guess,
@@ -60,49 +99,22 @@ def ip_timeline(ip: str):
 @bp.route("/stats")
 def global_stats():
     """Global honeypot statistics."""
-    from .analytics import severity
-    
-    state = _pipeline.state
-    total_ips = len(state.by_ip)
-    
-    severity_counts = {"info": 0, "warn": 0, "critical": 0}
-    attack_types = {}
-    total_events = 0
-    
-    for ip, st in state.by_ip.items():
-        sev = severity(st.score)
-        severity_counts[sev] += 1
-        
-        guess = st.attack_type_guess
-        attack_types[guess] = attack_types.get(guess, 0) + 1
-        total_events += len(st.timeline)
-    
-    return jsonify({
-        "total_ips": total_ips,
-        "total_events": total_events,
-        "by_severity": severity_counts,
-        "by_attack_type": attack_types
-    })
+    return _ojsonify(_pipeline.state.stats())
 
 
 @bp.route("/alerts")
 def recent_alerts():
     """Read recent alerts from sentinel file."""
-    import json
-    from pathlib import Path
-    
-    sentinel_file = Path("sentinel_events.jsonl")
+    sentinel_file = sentinel.SENTINEL_FILE
     alerts = []
     
     if sentinel_file.exists():
-        lines = sentinel_file.read_text().strip().split("\n")
-        # Last N alerts, newest first
+        # Last N alerts, newest first (N <= 0: all but the oldest -N)
         limit = request.args.get("limit", 50, type=int)
-        for line in reversed(lines[-limit:]):
-            if line.strip():
-                try:
-                    alerts.append(json.loads(line))
-                except json.JSONDecodeError:
-                    pass
+        for line in reversed(_tail_lines(sentinel_file, limit)):
+            try:
+                alerts.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                pass
     
-    return jsonify({"alerts": alerts})
\ No newline at end of file
+    return _ojsonify({"alerts": alerts})
\ No newline at end of file
@@ -1,43 +1,55 @@
 # detection/pipeline.py
 from __future__ import annotations
+import time
 from datetime import datetime, timezone
 from typing import Dict, Optional
 
 from .state import DetectionState
-from .scoring import score_event
-from .analytics import severity
+from .scoring import TAG_INDEX, score_event
+from .analytics import severity, ip_top_tags
 from .sentinel import send_alert
 
 WARN_THRESHOLD = 60
 CRIT_THRESHOLD = 100
 
+
+def _event_epoch(event: Dict) -> float:
+    """Event time as epoch seconds; ISO strings are only parsed for legacy events."""
+    if ts := event.get("ts_epoch"):
+        return ts
+    try:
+        # older logger.py used datetime.utcnow().isoformat() (no tz)
+        event_time = datetime.fromisoformat(event.get("timestamp"))
+        if event_time.tzinfo is None:
+            event_time = event_time.replace(tzinfo=timezone.utc)
+        return event_time.timestamp()
+    except Exception:
+        return time.time()
+
+
 class DetectionPipeline:
     def __init__(self):
         self.state = DetectionState()
         # Track last severity per IP to avoid spamming alerts
         self._last_severity = {}
 
-    def process_event(self, event: Dict, ai_risk_score: Optional[float] = None) -> Dict:
+    def process_event(self, event: Dict, ai_risk_score: Optional[float] = None) -> Optional[Dict]:
         """
-        Takes the event produced by logger.log_event() and returns an enriched event.
+        Takes the event produced by logger.log_event(), enriches it in place and returns it.
+        Never raises (called from after_request); returns None on failure.
         """
-        ip = event.get("ip") or "unknown"
-        st = self.state.get_ip(ip)
-
-        # Parse timestamp
-        ts = event.get("timestamp")
         try:
-            # logger.py uses datetime.utcnow().isoformat() (no tz)
-            event_time = datetime.fromisoformat(ts)
-            if event_time.tzinfo is None:
-                event_time = event_time.replace(tzinfo=timezone.utc)
-        except Exception:
-            event_time = datetime.now(timezone.utc)
+            return self._process(event, ai_risk_score)
+        except Exception as e:
+            print(f"[DETECTION_PIPELINE_ERROR] {e}")
+            return None
 
-        st.last_seen = event_time
+    def _process(self, event: Dict, ai_risk_score: Optional[float]) -> Dict:
+        ip = event.get("ip") or "unknown"
+        st = self.state.get_ip(ip)
 
-        # Main scoring
-        delta, tags, attack_guess, reasons = score_event(event, st)
+        event_ts = _event_epoch(event)
+        self.state.touch(ip, event_ts)
 
         # Optional AI hint boost (cap at +20)
         boost = 0
@@ -49,28 +61,37 @@ class DetectionPipeline:
                 boost = round(ai_risk_score * 0.2)
             boost = max(0, min(20, boost))
 
-        total_delta = delta + boost
-        st.score += total_delta
-
-        # Update tags + guess
-        for t in tags:
-            st.tags[t] += 1
-        st.attack_type_guess = attack_guess
-
-        sev = severity(st.score)
-
-        enriched = {
-            **event,
-            "score_delta": total_delta,
-            "score_total": st.score,
-            "tags": tags,
-            "attack_type_guess": attack_guess,
-            "severity": sev,
-            "reasons": reasons,
-            "ai_boost": boost,
-        }
-
-        st.timeline.append(enriched)
+        # score_event updates st's rate windows and score cache, so events for
+        # one IP from concurrent requests are scored one at a time.
+        with self.state.lock:
+            # Main scoring
+            delta, tags, attack_guess, reasons = score_event(event, st)
+
+            total_delta = delta + boost
+            score_total = self.state.add_score(ip, total_delta)
+
+            # Update tags + guess
+            counts = st.tag_counts
+            for t in tags:
+                counts[TAG_INDEX[t]] += 1
+            if tags:
+                st.tags_version += 1
+            self.state.set_attack_type(st, attack_guess)
+
+        sev = severity(score_total)
+
+        # The event is ours once logged (the DB writer got its own copy), so
+        # enrich it in place rather than copying it.
+        enriched = event
+        enriched["score_delta"] = total_delta
+        enriched["score_total"] = score_total
+        enriched["tags"] = tags
+        enriched["attack_type_guess"] = attack_guess
+        enriched["severity"] = sev
+        enriched["reasons"] = reasons
+        enriched["ai_boost"] = boost
+
+        self.state.add_timeline_event(st, enriched)
 
         # Alerting (only when crossing or severity changes)
         prev = self._last_severity.get(ip, "info")
@@ -82,16 +103,16 @@ class DetectionPipeline:
                 "provider": "honeypot",
                 "ip": ip,
                 "severity": sev,
-                "score": st.score,
+                "score": score_total,
                 "attack_type_guess": attack_guess,
-                "top_tags": [t for t, _ in st.tags.most_common(5)],
+                "top_tags": ip_top_tags(st, 5),
                 "evidence": {
                     "last_path": event.get("path"),
                     "last_method": event.get("method"),
                     "last_user_agent": event.get("user_agent"),
                     "last_reasons": reasons,
                 },
-                "time": event_time.isoformat(),
+                "time": datetime.fromtimestamp(event_ts, timezone.utc).isoformat(),
             }
             send_alert(alert)
 
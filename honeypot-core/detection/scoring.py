@@ -1,8 +1,11 @@
 # detection/scoring.py
 from __future__ import annotations
 import re
-from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Tuple
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import orjson
 
 # --- Endpoint weights (simple + effective) ---
 ENDPOINT_WEIGHTS = [
@@ -15,6 +18,43 @@ ENDPOINT_WEIGHTS = [
     (re.compile(r"^/$"), 0, "root"),
 ]
 
+# Patterns that are just a literal path with an optional trailing slash are
+# looked up in a dict; the rest (wildcards) are tried as one anchored
+# alternation in list order. A literal is only added if no earlier pattern
+# already claims it, so the first listed pattern that matches still wins.
+_LITERAL_ENDPOINT_RE = re.compile(r"\^(/[\w/-]*?)(/\?)?\$")
+
+
+def _split_endpoints() -> Tuple[Dict[str, Tuple[int, str]], List[Tuple[int, re.Pattern]]]:
+    exact: Dict[str, Tuple[int, str]] = {}
+    wildcards: List[Tuple[int, re.Pattern]] = []
+    for i, (pattern, weight, tag) in enumerate(ENDPOINT_WEIGHTS):
+        m = _LITERAL_ENDPOINT_RE.fullmatch(pattern.pattern)
+        if m is None:
+            wildcards.append((i, pattern))
+            continue
+        for path in (m.group(1), m.group(1) + "/") if m.group(2) else (m.group(1),):
+            if path not in exact and not any(w.match(path) for _, w in wildcards):
+                exact[path] = (weight, tag)
+    return exact, wildcards
+
+
+_EXACT_ENDPOINTS, _WILDCARDS = _split_endpoints()
+_WILDCARD_RE = re.compile("|".join(
+    f"(?P<e{i}>{pattern.pattern.removeprefix('^')})" for i, pattern in _WILDCARDS
+) or "(?!)")
+_WILDCARD_META = {f"e{i}": ENDPOINT_WEIGHTS[i][1:] for i, _ in _WILDCARDS}
+
+
+def _endpoint_hit(path: str) -> Optional[Tuple[int, str]]:
+    """(weight, tag) of the first ENDPOINT_WEIGHTS entry matching path, if any."""
+    hit = _EXACT_ENDPOINTS.get(path)
+    if hit is None:
+        m = _WILDCARD_RE.match(path)
+        if m:
+            hit = _WILDCARD_META[m.lastgroup]
+    return hit
+
 # --- Keyword indicators ---
 INDICATORS = [
     # scanners / tooling
@@ -29,56 +69,136 @@ INDICATORS = [
     (re.compile(r"(169\.254\.169\.254|metadata\.google\.internal)", re.I), 25, "ssrf"),
 ]
 
-def _utcnow() -> datetime:
-    return datetime.now(timezone.utc)
+# Tags added by the rate/burst checks in score_event
+RATE_TAGS = ("rate-spike", "rate-elevated", "path-sweep")
+
+# Closed tag vocabulary; per-IP tag counts are arrays indexed by TAG_INDEX.
+ALL_TAGS: Tuple[str, ...] = tuple(dict.fromkeys(
+    [tag for _, _, tag in ENDPOINT_WEIGHTS + INDICATORS] + list(RATE_TAGS)
+))
+TAG_INDEX: Dict[str, int] = {tag: i for i, tag in enumerate(ALL_TAGS)}
+
+_ALL_INDICATORS = frozenset(range(len(INDICATORS)))
+
+@lru_cache(maxsize=None)
+def _indicator_re(remaining: frozenset) -> re.Pattern:
+    # Zero-width lookaheads, so a match at one position doesn't consume text
+    # another indicator might need.
+    return re.compile(
+        "|".join(f"(?=(?P<i{i}>{INDICATORS[i][0].pattern}))" for i in sorted(remaining)),
+        re.I,
+    )
+
+def _indicator_hits(fragments: List[str]) -> List[int]:
+    """
+    Indices of INDICATORS that match anywhere in any fragment, in list order.
+    One combined scan per fragment; after each hit the scan resumes at the
+    same position with only the indicators not yet found, and stops once
+    every indicator has fired.
+    """
+    remaining = _ALL_INDICATORS
+    for frag in fragments:
+        pos = 0
+        while remaining:
+            m = _indicator_re(remaining).search(frag, pos)
+            if m is None:
+                break
+            remaining = remaining - {int(m.lastgroup[1:])}
+            pos = m.start()
+        if not remaining:
+            break
+    return sorted(_ALL_INDICATORS - remaining)
+
+def _query_str(query: Dict) -> str:
+    # k=v&k=v, as on the wire, so patterns like "cmd=" can match
+    return "&".join(f"{k}={v}" for k, v in query.items())
+
+def _body_str(body) -> str:
+    if isinstance(body, str):
+        return body
+    return orjson.dumps(body, default=str).decode()
+
+SCORE_CACHE_SIZE = 16            # per IP
+SCORE_CACHE_MAX_CHARS = 4096     # larger events are scored but not cached
+
+def _static_score(fragments: List[str], cache) -> Tuple[int, Tuple[str, ...], Optional[Dict], Tuple[Dict, ...]]:
+    """
+    Endpoint + indicator part of the score: (score, tags, endpoint reason,
+    indicator reasons). Memoized in the IP's small LRU keyed on the exact
+    fragments, so only identical probes hit.
+    """
+    key = tuple(fragments)
+    hit = cache.get(key)
+    if hit is not None:
+        cache.move_to_end(key)
+        return hit
+
+    path = fragments[0]
+    score = 0
+    tags: List[str] = []
+    endpoint = None
+    indicators = []
+
+    # 1) endpoint weight
+    hit = _endpoint_hit(path)
+    if hit:
+        weight, tag = hit
+        score += weight
+        tags.append(tag)
+        endpoint = {"path": path, "weight": weight, "tag": tag}
+
+    # 2) indicators in payload / UA / query
+    for i in _indicator_hits(fragments):
+        pattern, weight, tag = INDICATORS[i]
+        score += weight
+        tags.append(tag)
+        indicators.append({"tag": tag, "weight": weight, "match": pattern.pattern})
+
+    result = (score, tuple(tags), endpoint, tuple(indicators))
+    if sum(map(len, fragments)) <= SCORE_CACHE_MAX_CHARS:
+        cache[key] = result
+        if len(cache) > SCORE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return result
 
 def score_event(event: Dict, ip_state) -> Tuple[int, List[str], str, Dict]:
     """
     Returns: (score_delta, tags, attack_type_guess, debug_reasons)
-    ip_state is your DetectionState's IPState (from state.py).
+    ip_state is your DetectionState's IPState (from state.py). Its rate
+    windows and score cache are updated here without locking, so callers
+    hold DetectionState.lock for concurrent events on one IP.
     """
     path = (event.get("path") or "").strip()
-    method = (event.get("method") or "").upper()
     ua = (event.get("user_agent") or "") or (event.get("headers", {}).get("User-Agent") if isinstance(event.get("headers"), dict) else "") or ""
     body = event.get("body")
     query = event.get("query_params") or {}
 
-    # Combine content into one string to scan
-    parts = [path, method, ua]
+    # Scan each piece on its own (no joined copy); query/body are only
+    # rendered when present.
+    fragments = [path, ua]
     if isinstance(query, dict) and query:
-        parts.append(str(query))
+        fragments.append(_query_str(query))
     if body is not None:
-        parts.append(str(body))
-    haystack = " | ".join(parts)
-
-    score = 0
-    tags: List[str] = []
-    reasons = {"endpoint": None, "indicators": [], "rate": None, "burst": None}
-
-    # 1) endpoint weight
-    for pattern, weight, tag in ENDPOINT_WEIGHTS:
-        if pattern.match(path):
-            score += weight
-            tags.append(tag)
-            reasons["endpoint"] = {"path": path, "weight": weight, "tag": tag}
-            break
-
-    # 2) indicators in payload / UA / query
-    for pattern, weight, tag in INDICATORS:
-        if pattern.search(haystack):
-            score += weight
-            tags.append(tag)
-            reasons["indicators"].append({"tag": tag, "weight": weight, "match": pattern.pattern})
+        fragments.append(_body_str(body))
+
+    # 1) + 2) depend only on the fragments; repeat probes reuse the result
+    static = _static_score(fragments, ip_state.score_cache)
+    score = static[0]
+    tags: List[str] = list(static[1])
+    reasons = {
+        "endpoint": dict(static[2]) if static[2] else None,
+        "indicators": [dict(r) for r in static[3]],
+        "rate": None,
+        "burst": None,
+    }
 
     # 3) rate / burst behavior (based on ip_state rolling windows)
-    now = _utcnow()
-    ip_state.req_times.append(now)
-    ip_state.recent_paths.append((now, path))
+    now_ts = time.time()
+    ip_state.req_times.append(now_ts)
+    ip_state.recent_paths.append(now_ts, path)
 
     # Rate: requests in last 60s
-    one_min_ago = now - timedelta(seconds=60)
-    req_last_min = [t for t in ip_state.req_times if t >= one_min_ago]
-    rpm = len(req_last_min)
+    rpm = ip_state.req_times.count_since(now_ts - 60)
 
     if rpm > 30:
         score += 20
@@ -90,9 +210,7 @@ def score_event(event: Dict, ip_state) -> Tuple[int, List[str], str, Dict]:
         reasons["rate"] = {"rpm": rpm, "added": 10}
 
     # Burst: distinct paths in last 30s
-    thirty_sec_ago = now - timedelta(seconds=30)
-    recent = [p for (t, p) in ip_state.recent_paths if t >= thirty_sec_ago]
-    distinct = len(set(recent))
+    distinct = ip_state.recent_paths.distinct_since(now_ts - 30)
     if distinct >= 10:
         score += 15
         tags.append("path-sweep")
@@ -104,13 +222,10 @@ def score_event(event: Dict, ip_state) -> Tuple[int, List[str], str, Dict]:
     return score, dedupe(tags), attack_type_guess, reasons
 
 def dedupe(tags: List[str]) -> List[str]:
-    out = []
-    seen = set()
-    for t in tags:
-        if t not in seen:
-            seen.add(t)
-            out.append(t)
-    return out
+    # dict preserves insertion order, so this keeps first occurrences in order.
+    return list(dict.fromkeys(tags))
+
+_RECON_TAGS = frozenset({"admin-probe", "config-probe", "backup-probe"})
 
 def guess_attack_type(tags: List[str]) -> str:
     # Priority based on “most meaningful” indicators
@@ -126,6 +241,6 @@ def guess_attack_type(tags: List[str]) -> str:
         return "credential-stuffing"
     if "path-sweep" in tags or "scanner-tool" in tags:
         return "automated-scan"
-    if any(t in tags for t in ["admin-probe", "config-probe", "backup-probe"]):
+    if not _RECON_TAGS.isdisjoint(tags):
         return "recon"
     return "unknown"
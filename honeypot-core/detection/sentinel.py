@@ -1,23 +1,150 @@
 # detection/sentinel.py
 from __future__ import annotations
-import json
+import os
+import queue
+import threading
+import time
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
+
+import orjson
 
 SENTINEL_FILE = Path("sentinel_events.jsonl")
 
+# Alerts are queued by send_alert() and appended to SENTINEL_FILE in batches
+# by a single daemon writer, so the request thread never touches the disk.
+# The writer is started lazily (and again after fork) so gunicorn workers
+# forked from a preloaded app each get their own.
+MAX_BATCH = 256
+BATCH_WINDOW_SEC = 0.05  # how long the writer waits to fill a batch
+_alert_queue: Optional["queue.Queue[Dict]"] = None
+_writer_lock = threading.Lock()
+_dropped = 0  # alerts lost to a full queue or bad data since start (or fork)
+_dropped_lock = threading.Lock()  # request threads and the writer both count drops
+
+
+# (epoch second, ISO string) of the last formatted timestamp
+_ts_cache: Tuple[int, str] = (0, "")
+
+
 def _utcnow_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
+    """Second-resolution UTC timestamp, formatted at most once per second."""
+    global _ts_cache
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        _ts_cache = (now, datetime.fromtimestamp(now, timezone.utc).isoformat())
+    return _ts_cache[1]
+
+
+def _write_all(fd: int, buf: bytes) -> None:
+    view = memoryview(buf)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _count_drop() -> int:
+    """Count one dropped alert; returns the new total."""
+    global _dropped
+    with _dropped_lock:
+        _dropped += 1
+        return _dropped
+
+
+def _serialize(batch: List[Dict]) -> bytes:
+    """JSONL for the batch; alerts that can't be encoded are dropped and counted."""
+    lines = []
+    for alert in batch:
+        try:
+            lines.append(orjson.dumps(alert, default=str, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS))
+        except orjson.JSONEncodeError as e:
+            print(f"[SENTINEL] unserializable alert dropped ({_count_drop()} total): {e}")
+    return b"".join(lines)
+
+
+def _drain(q: "queue.Queue[Dict]") -> None:
+    fd, path = None, None
+    while True:
+        batch: List[Dict] = [q.get()]
+        deadline = time.monotonic() + BATCH_WINDOW_SEC
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(q.get(timeout=remaining))
+                else:
+                    batch.append(q.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            buf = _serialize(batch)
+            if path != SENTINEL_FILE:  # first batch, or the target was changed
+                if fd is not None:
+                    os.close(fd)
+                    fd = None
+                SENTINEL_FILE.parent.mkdir(parents=True, exist_ok=True)
+                fd = os.open(SENTINEL_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                path = SENTINEL_FILE
+            _write_all(fd, buf)
+        except OSError as e:
+            print(f"[SENTINEL] write failed, dropped {len(batch)} alerts: {e}")
+        finally:
+            for _ in batch:
+                q.task_done()
+
+
+def _start_writer() -> "queue.Queue[Dict]":
+    global _alert_queue
+    with _writer_lock:
+        if _alert_queue is None:
+            q: "queue.Queue[Dict]" = queue.Queue(maxsize=10000)
+            threading.Thread(target=_drain, args=(q,), name="sentinel-writer", daemon=True).start()
+            _alert_queue = q
+    return _alert_queue
+
+
+def _reset_after_fork() -> None:
+    global _alert_queue, _writer_lock, _dropped, _dropped_lock
+    _alert_queue = None
+    _writer_lock = threading.Lock()
+    _dropped = 0
+    _dropped_lock = threading.Lock()
+
+
+def _enqueue(q: "queue.Queue[Dict]", alert: Dict, emitted_at: str) -> None:
+    try:
+        q.put_nowait({**alert, "emitted_at": emitted_at})
+    except queue.Full:
+        print(f"[SENTINEL] alert queue full, alert dropped ({_count_drop()} total)")
+
 
 def send_alert(alert: Dict) -> None:
     """
-    Hackathon stub: write newline-delimited JSON and print.
+    Hackathon stub: queue the alert for the background JSONL writer.
     Replace with HTTP collector later if needed.
     """
-    alert = {**alert, "emitted_at": _utcnow_iso()}
-    line = json.dumps(alert, ensure_ascii=False)
-    print("[SENTINEL]", line)
-    SENTINEL_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with SENTINEL_FILE.open("a", encoding="utf-8") as f:
-        f.write(line + "\n")
+    _enqueue(_alert_queue or _start_writer(), alert, _utcnow_iso())
+
+
+def send_alert_batch(alerts: List[Dict]) -> None:
+    """Queue several alerts at once; they share one emitted_at."""
+    q = _alert_queue or _start_writer()
+    emitted_at = _utcnow_iso()
+    for alert in alerts:
+        _enqueue(q, alert, emitted_at)
+
+
+def dropped_count() -> int:
+    return _dropped
+
+
+def flush() -> None:
+    """Block until every queued alert has been written (for tests/shutdown)."""
+    q = _alert_queue
+    if q is not None:
+        q.join()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
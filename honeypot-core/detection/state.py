@@ -1,30 +1,144 @@
 # detection/state.py
 from __future__ import annotations
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
 from dataclasses import dataclass, field
-from datetime import datetime, timedelta, timezone
-from collections import deque, Counter
+from collections import Counter, OrderedDict, deque
+from itertools import islice
 from typing import Deque, Dict, List, Optional, Tuple
 
-def _utcnow() -> datetime:
-    return datetime.now(timezone.utc)
+from sortedcontainers import SortedList
 
-@dataclass
+from .analytics import severity
+from .scoring import ALL_TAGS
+
+class TimeRing:
+    """
+    Fixed-size ring of epoch timestamps; the oldest entries are overwritten.
+    Timestamps are appended in order, so each half of the ring is sorted and
+    window counts are two binary searches.
+    """
+    __slots__ = ("_buf", "_size", "_next", "_count")
+
+    def __init__(self, size: int = 500):
+        self._buf = array("d", bytes(8 * size))
+        self._size = size
+        self._next = 0  # slot written by the next append()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, ts: float) -> None:
+        self._buf[self._next] = ts
+        self._next = (self._next + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+
+    def count_since(self, cutoff: float) -> int:
+        """Number of stored timestamps >= cutoff."""
+        buf, head, size = self._buf, self._next, self._size
+        newest = head - bisect_left(buf, cutoff, 0, head)
+        if self._count < size:
+            return newest
+        # Full ring: buf[head:] holds the older half, buf[:head] the newer one.
+        return newest + (size - bisect_left(buf, cutoff, head, size))
+
+class PathWindow:
+    """
+    Recent (epoch ts, path) pairs with a running count per path, so the
+    number of distinct paths in a trailing window needs no rescan. Entries
+    older than the window are evicted from the left as they expire.
+    """
+    __slots__ = ("_items", "_counts", "_maxlen")
+
+    def __init__(self, maxlen: int = 500):
+        self._items: Deque[Tuple[float, str]] = deque()
+        self._counts: Dict[str, int] = {}
+        self._maxlen = maxlen
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _pop_oldest(self) -> None:
+        _, path = self._items.popleft()
+        n = self._counts[path] - 1
+        if n:
+            self._counts[path] = n
+        else:
+            del self._counts[path]
+
+    def append(self, ts: float, path: str) -> None:
+        if len(self._items) >= self._maxlen:
+            self._pop_oldest()
+        self._items.append((ts, path))
+        self._counts[path] = self._counts.get(path, 0) + 1
+
+    def distinct_since(self, cutoff: float) -> int:
+        """Distinct paths among entries with ts >= cutoff (older ones are dropped)."""
+        items = self._items
+        while items and items[0][0] < cutoff:
+            self._pop_oldest()
+        return len(self._counts)
+
+@dataclass(slots=True)
 class IPState:
+    """
+    Per-IP detection state. `score` writes go through the owning
+    DetectionState.update_score() so its by_score index and severity counts
+    stay in step.
+    """
     ip: str
-    score: int = 0
-    last_seen: Optional[datetime] = None
-    tags: Counter = field(default_factory=Counter)
+    _score: int = 0
+    last_seen: Optional[float] = None  # epoch seconds
+    # Hit count per tag, indexed by scoring.TAG_INDEX
+    tag_counts: array = field(default_factory=lambda: array("I", [0]) * len(ALL_TAGS))
+    # Bumped whenever tag_counts changes; top-tag lists are memoized per version.
+    tags_version: int = 0
+    top_tags_cache: Dict[int, List[str]] = field(default_factory=dict)  # k -> top k
+    top_tags_cache_version: int = -1
     attack_type_guess: str = "unknown"
 
     # Rolling request timestamps (for rate/burst checks)
-    req_times: Deque[datetime] = field(default_factory=lambda: deque(maxlen=500))
+    req_times: TimeRing = field(default_factory=TimeRing)
+
+    # Small LRU of endpoint/indicator results for repeated identical probes
+    score_cache: "OrderedDict[tuple, tuple]" = field(default_factory=OrderedDict)
 
     # Rolling path history (for distinct path burst checks)
-    recent_paths: Deque[Tuple[datetime, str]] = field(default_factory=lambda: deque(maxlen=500))
+    recent_paths: PathWindow = field(default_factory=PathWindow)
 
     # Timeline of enriched events (keep small for hackathon)
     timeline: Deque[dict] = field(default_factory=lambda: deque(maxlen=300))
 
+    # The DetectionState that indexes this IP, if any
+    _owner: Optional["DetectionState"] = field(default=None, repr=False, compare=False)
+
+    @property
+    def score(self) -> int:
+        return self._score
+
+    @score.setter
+    def score(self, value: int) -> None:
+        if self._owner is None:
+            self._score = value
+        else:
+            self._owner.update_score(self.ip, value)
+
+    def tail(self, k: int) -> List[dict]:
+        """
+        The last k timeline events, oldest first, without copying the whole
+        deque. Like timeline[-k:], k <= 0 keeps all but the first -k.
+        """
+        if k <= 0:
+            return list(self.timeline)[-k:]
+        events = list(islice(reversed(self.timeline), k))
+        events.reverse()
+        return events
+
 class DetectionState:
     """
     In-memory state store.
@@ -32,16 +146,112 @@ class DetectionState:
     """
     def __init__(self):
         self.by_ip: Dict[str, IPState] = {}
+        # (score, ip) for every tracked IP, kept sorted for the leaderboard.
+        # Kept in sync by update_score(), which IPState.score writes go through.
+        self.by_score: SortedList = SortedList()
+        # Min-heap of (last_seen epoch, ip) for prune_old. Entries go stale when
+        # an IP is seen again; they are skipped on pop and compacted in touch().
+        self._seen_heap: List[Tuple[float, str]] = []
+        # Request threads share one state: hold this around get-or-create and
+        # any read-modify-write of a score so by_ip and by_score stay in step.
+        self.lock = threading.RLock()
+        # Aggregates for /stats, kept in step with every tracked IP so the
+        # endpoint never scans by_ip. Change attack guesses and timelines
+        # through set_attack_type() / add_timeline_event(); guarded by lock.
+        self.sev_counts: Dict[str, int] = {"info": 0, "warn": 0, "critical": 0}
+        self.attack_type_counts: Counter = Counter()
+        self.total_events = 0
 
     def get_ip(self, ip: str) -> IPState:
-        if ip not in self.by_ip:
-            self.by_ip[ip] = IPState(ip=ip)
-        return self.by_ip[ip]
+        st = self.by_ip.get(ip)
+        if st is None:
+            with self.lock:
+                st = self.by_ip.get(ip)
+                if st is None:
+                    st = self.by_ip[ip] = IPState(ip=ip, _owner=self)
+                    self.by_score.add((st.score, ip))
+                    self.sev_counts[severity(st.score)] += 1
+                    self.attack_type_counts[st.attack_type_guess] += 1
+        return st
+
+    def update_score(self, ip: str, new_score: int) -> IPState:
+        with self.lock:
+            st = self.get_ip(ip)
+            if new_score != st.score:
+                prev_sev, new_sev = severity(st.score), severity(new_score)
+                if prev_sev != new_sev:
+                    self.sev_counts[prev_sev] -= 1
+                    self.sev_counts[new_sev] += 1
+                self.by_score.remove((st.score, ip))
+                st._score = new_score
+                self.by_score.add((new_score, ip))
+        return st
+
+    def add_score(self, ip: str, delta: int) -> int:
+        """Atomically add delta to ip's score; returns the new score."""
+        with self.lock:
+            st = self.update_score(ip, self.get_ip(ip).score + delta)
+            return st.score
+
+    def set_attack_type(self, st: IPState, guess: str) -> None:
+        with self.lock:
+            prev = st.attack_type_guess
+            if guess != prev:
+                self.attack_type_counts[prev] -= 1
+                if not self.attack_type_counts[prev]:
+                    del self.attack_type_counts[prev]
+                self.attack_type_counts[guess] += 1
+                st.attack_type_guess = guess
+
+    def add_timeline_event(self, st: IPState, event: dict) -> None:
+        with self.lock:
+            timeline = st.timeline
+            if len(timeline) != timeline.maxlen:
+                self.total_events += 1
+            timeline.append(event)
+
+    def stats(self) -> Dict:
+        """Snapshot of the /stats aggregates."""
+        with self.lock:
+            return {
+                "total_ips": len(self.by_ip),
+                "total_events": self.total_events,
+                "by_severity": dict(self.sev_counts),
+                "by_attack_type": dict(self.attack_type_counts),
+            }
+
+    def touch(self, ip: str, when: float) -> IPState:
+        """Record activity for ip at `when` (epoch seconds; sets last_seen)."""
+        with self.lock:
+            st = self.get_ip(ip)
+            st.last_seen = when
+            heap = self._seen_heap
+            heapq.heappush(heap, (when, ip))
+            if len(heap) > 2 * len(self.by_ip) + 64:
+                self._seen_heap = [(s.last_seen, key) for key, s in self.by_ip.items() if s.last_seen]
+                heapq.heapify(self._seen_heap)
+        return st
+
+    def top_by_score(self, limit: int) -> List[Tuple[int, str]]:
+        """Highest-scoring (score, ip) pairs, best first."""
+        with self.lock:
+            n = len(self.by_score)
+            return list(self.by_score.islice(max(0, n - limit), n, reverse=True))
 
     def prune_old(self, max_idle_minutes: int = 60) -> None:
         """Optional cleanup to avoid infinite growth."""
-        now = _utcnow()
-        cutoff = now - timedelta(minutes=max_idle_minutes)
-        to_delete = [ip for ip, st in self.by_ip.items() if (st.last_seen and st.last_seen < cutoff)]
-        for ip in to_delete:
-            del self.by_ip[ip]
+        cutoff = time.time() - max_idle_minutes * 60
+        with self.lock:
+            heap = self._seen_heap
+            while heap and heap[0][0] < cutoff:
+                ts, ip = heapq.heappop(heap)
+                st = self.by_ip.get(ip)
+                # Only the newest entry for an IP matches its last_seen.
+                if st is not None and st.last_seen == ts:
+                    del self.by_ip[ip]
+                    self.by_score.discard((st.score, ip))
+                    self.sev_counts[severity(st.score)] -= 1
+                    self.attack_type_counts[st.attack_type_guess] -= 1
+                    if not self.attack_type_counts[st.attack_type_guess]:
+                        del self.attack_type_counts[st.attack_type_guess]
+                    self.total_events -= len(st.timeline)
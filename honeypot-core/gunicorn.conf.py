@@ -0,0 +1,21 @@
+# gunicorn.conf.py
+# Picked up automatically by `gunicorn app:app` when run from honeypot-core/.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# gthread workers: handlers mostly wait on Mongo / Azure OpenAI, so threads
+# give concurrency inside each worker and processes spread the CPU work.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = 120
+
+# Import app.py once in the master and fork workers from it (copy-on-write).
+# Note: DetectionPipeline state is in-memory, so each worker scores the IPs it
+# happens to serve; set WEB_CONCURRENCY=1 for a single global view.
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
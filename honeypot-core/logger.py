@@ -2,20 +2,24 @@
 from __future__ import annotations
 
 import os
+import queue
+import threading
+import time
 import uuid
 from datetime import datetime, timezone
 import hashlib
-from typing import Any, Dict, Optional
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
 from passlib.hash import pbkdf2_sha256
 
-from pymongo import MongoClient, errors
+from pymongo import MongoClient, UpdateOne, errors
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Optional: keep last N events in memory (useful for debugging)
-EVENT_LOGS = []
 MAX_INMEM_EVENTS = 200
+EVENT_LOGS: Deque[Dict[str, Any]] = deque(maxlen=MAX_INMEM_EVENTS)
 
 _client: Optional[MongoClient] = None
 _db = None
@@ -29,7 +33,102 @@ def _utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+# ----------------------------
+# Background writer
+# ----------------------------
+# Request handlers only enqueue (collection, payload) pairs. One daemon thread
+# per process drains the queue for up to WRITE_WINDOW_SEC and flushes each
+# collection with a single insert_many / bulk_write.
+
+WRITE_BATCH = 4096
+WRITE_WINDOW_SEC = 0.01
+
+_write_queue: Optional["queue.Queue[Tuple[str, Any]]"] = None
+_writer_lock = threading.Lock()
+
+
+def _enqueue(kind: str, payload: Any) -> None:
+    q = _write_queue or _start_writer()
+    try:
+        q.put_nowait((kind, payload))
+    except queue.Full:
+        print(f"[logger] write queue full, dropped {kind} write")
+
+
+def _start_writer() -> "queue.Queue[Tuple[str, Any]]":
+    global _write_queue
+    with _writer_lock:
+        if _write_queue is None:
+            q: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=100_000)
+            threading.Thread(target=_drain, args=(q,), name="logger-writer", daemon=True).start()
+            _write_queue = q
+    return _write_queue
+
+
+def _reset_after_fork() -> None:
+    global _write_queue, _writer_lock
+    _write_queue = None
+    _writer_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
 
+def flush() -> None:
+    """Block until every queued write has been flushed (for tests/shutdown)."""
+    q = _write_queue
+    if q is not None:
+        q.join()
+
+
+def _drain(q: "queue.Queue[Tuple[str, Any]]") -> None:
+    while True:
+        batch = [q.get()]
+        deadline = time.monotonic() + WRITE_WINDOW_SEC
+        while len(batch) < WRITE_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            _flush(batch)
+        except Exception as e:
+            print(f"[logger] flush failed, dropped {len(batch)} writes: {e}")
+        finally:
+            for _ in batch:
+                q.task_done()
+
+
+def _flush(batch) -> None:
+    if not init_db():
+        return
+
+    grouped: Dict[str, list] = {"events": [], "deceptions": [], "alerts": [], "sessions": []}
+    for kind, payload in batch:
+        if kind == "dispatch":
+            _expand_dispatch(payload, grouped)
+        else:
+            grouped[kind].append(payload)
+
+    for kind, coll in (("events", _events), ("deceptions", _deceptions), ("alerts", _alerts)):
+        docs = grouped[kind]
+        if not docs or coll is None:
+            continue
+        try:
+            coll.insert_many(docs, ordered=False)
+        except errors.PyMongoError as e:
+            print(f"[logger] insert {kind} failed: {e}")
+
+    # Session updates are applied in arrival order so $set/$max stay consistent.
+    if grouped["sessions"] and _sessions is not None:
+        try:
+            _sessions.bulk_write(grouped["sessions"], ordered=True)
+        except errors.PyMongoError as e:
+            print(f"[logger] session updates failed: {e}")
 
 
 def log_event(event_dict: Dict[str, Any]) -> Dict[str, Any]:
@@ -37,25 +136,20 @@ def log_event(event_dict: Dict[str, Any]) -> Dict[str, Any]:
     Store an incoming request/event.
     Returns the full event object (with event_id/timestamp).
     """
-    init_db()
-
     event = {
-        "event_id": str(uuid.uuid4()),
+        "event_id": os.urandom(16).hex(),
         "timestamp": _utc_now_iso(),
+        "ts_epoch": time.time(),
         **event_dict,
     }
 
-    # In-memory (optional)
-    EVENT_LOGS.append(event)
-    if len(EVENT_LOGS) > MAX_INMEM_EVENTS:
-        EVENT_LOGS.pop(0)
+    # In-memory (optional). The log and the DB writer each get their own
+    # copy: insert_many adds _id, and the detection pipeline enriches the
+    # returned event in place.
+    EVENT_LOGS.append(dict(event))
 
-    # DB write (best-effort)
-    if _events is not None:
-        try:
-            _events.insert_one(event)
-        except errors.PyMongoError as e:
-            print(f"[logger] insert event failed: {e}")
+    # DB write (best-effort, background)
+    _enqueue("events", dict(event))
 
     return event
 
@@ -65,59 +159,44 @@ def log_deception(deception_dict: Dict[str, Any]) -> Dict[str, Any]:
     """
     Store the deception result generated by Person 2 engine.
     """
-    init_db()
+    deception = _deception_doc(_utc_now_iso(), deception_dict)
+
+    _enqueue("deceptions", dict(deception))
+
+    return deception
+
 
-    deception = {
+def _deception_doc(now: str, deception_dict: Dict[str, Any]) -> Dict[str, Any]:
+    return {
         "deception_id": str(uuid.uuid4()),
-        "timestamp": _utc_now_iso(),
+        "timestamp": now,
         **deception_dict,
     }
 
-    if _deceptions is not None:
-        try:
-            _deceptions.insert_one(deception)
-        except errors.PyMongoError as e:
-            print(f"[logger] insert deception failed: {e}")
-
-    return deception
-
 
 def upsert_session(session_id: str, update: Dict[str, Any]) -> None:
-    init_db()
-    if _sessions is None:
-        return
-
     now = _utc_now_iso()
 
-    try:
-        _sessions.update_one(
-            {"session_id": session_id},
-            {
-                "$set": {**(update or {}), "last_seen": now},
-                "$setOnInsert": {
-                    "session_id": session_id,
-                    "first_seen": now,
-                    "max_risk": 0,
-                },
-                "$inc": {"total_requests": 1},
+    _enqueue("sessions", UpdateOne(
+        {"session_id": session_id},
+        {
+            "$set": {**(update or {}), "last_seen": now},
+            "$setOnInsert": {
+                "session_id": session_id,
+                "first_seen": now,
+                "max_risk": 0,
             },
-            upsert=True,
-        )
-        print(f"[logger] upsert_session ok session_id={session_id}")
-    except errors.PyMongoError as e:
-        print(f"[logger] upsert session failed: {e}")
-def update_session_max_risk(session_id: str, risk: int) -> None:
-    init_db()
-    if _sessions is None:
-        return
+            "$inc": {"total_requests": 1},
+        },
+        upsert=True,
+    ))
 
-    try:
-        _sessions.update_one(
-            {"session_id": session_id},
-            {"$max": {"max_risk": int(risk)}},
-        )
-    except errors.PyMongoError as e:
-        print(f"[logger] update max_risk failed: {e}")
+
+def update_session_max_risk(session_id: str, risk: int) -> None:
+    _enqueue("sessions", UpdateOne(
+        {"session_id": session_id},
+        {"$max": {"max_risk": int(risk)}},
+    ))
 
 
 # ----------------------------
@@ -155,23 +234,38 @@ def upsert_user(username: str, password_plain: Any, role: str = "user", is_activ
     )
 
 
-def check_credentials(username: str, password_plain: Any) -> bool:
+def lookup_user(username: str) -> Tuple[bool, Optional[str], Optional[str]]:
+    """
+    Single users-collection read for the login/admin handlers.
+    Returns (exists, password_hash, role); password_hash is None when the
+    account is inactive or has no usable hash.
+    """
     init_db()
-    if _users is None:
-        return False
+    if _users is None or not username:
+        return False, None, None
 
-    doc = _users.find_one({"username": username}, {"password_hash": 1, "is_active": 1})
-    if not doc or not doc.get("is_active", True):
-        return False
+    doc = _users.find_one({"username": username}, {"password_hash": 1, "is_active": 1, "role": 1})
+    if not doc:
+        return False, None, None
 
     pw_hash = doc.get("password_hash")
-    if not isinstance(pw_hash, str) or not pw_hash:
-        return False
+    if not doc.get("is_active", True) or not isinstance(pw_hash, str) or not pw_hash:
+        pw_hash = None
+    return True, pw_hash, doc.get("role")
+
 
+def verify_password(password_plain: Any, pw_hash: Optional[str]) -> bool:
+    if not pw_hash:
+        return False
     pw_norm = _normalize_password(password_plain)      # str
     return pbkdf2_sha256.verify(pw_norm, pw_hash)
 
 
+def check_credentials(username: str, password_plain: Any) -> bool:
+    _, pw_hash, _ = lookup_user(username)
+    return verify_password(password_plain, pw_hash)
+
+
 def user_exists(username: str) -> bool:
     init_db()
     if _users is None:
@@ -273,11 +367,26 @@ def record_session_activity(
     - flags (deduped)
     - counters
     """
-    init_db()
-    if _sessions is None:
-        return
+    _enqueue("sessions", _session_activity_op(
+        session_id, _utc_now_iso(),
+        ip=ip, user_agent=user_agent, path=path, method=method, status_code=status_code,
+        risk=risk, flags=flags, counters_inc=counters_inc,
+    ))
 
-    now = _utc_now_iso()
+
+def _session_activity_op(
+    session_id: str,
+    now: str,
+    *,
+    ip: str,
+    user_agent: str,
+    path: str,
+    method: str,
+    status_code: int,
+    risk: int,
+    flags: List[str] | None = None,
+    counters_inc: Dict[str, int] | None = None,
+) -> UpdateOne:
     risk = int(risk)
 
     update_doc: Dict[str, Any] = {
@@ -316,10 +425,7 @@ def record_session_activity(
     if flags:
         update_doc["$addToSet"] = {"flags": {"$each": list(flags)}}
 
-    try:
-        _sessions.update_one({"session_id": session_id}, update_doc, upsert=True)
-    except errors.PyMongoError as e:
-        print(f"[logger] record_session_activity failed: {e}")
+    return UpdateOne({"session_id": session_id}, update_doc, upsert=True)
 
 
 def create_alert(
@@ -332,13 +438,26 @@ def create_alert(
     reason: str,
     risk: int,
 ) -> None:
-    init_db()
-    if _alerts is None:
-        return
+    _enqueue("alerts", _alert_doc(
+        _utc_now_iso(), session_id, ip, user_agent,
+        severity=severity, alert_type=alert_type, reason=reason, risk=risk,
+    ))
 
-    doc = {
+
+def _alert_doc(
+    now: str,
+    session_id: str,
+    ip: str,
+    user_agent: str,
+    *,
+    severity: str,
+    alert_type: str,
+    reason: str,
+    risk: int,
+) -> Dict[str, Any]:
+    return {
         "alert_id": str(uuid.uuid4()),
-        "timestamp": _utc_now_iso(),
+        "timestamp": now,
         "session_id": session_id,
         "ip": ip,
         "user_agent": user_agent,
@@ -349,11 +468,39 @@ def create_alert(
         "status": "OPEN",         # OPEN/ACK/CLOSED
     }
 
-    try:
-        result = _alerts.insert_one(doc)
-        print(f"[logger] create_alert success: alert_id={doc['alert_id']}, inserted_id={result.inserted_id}")
-    except errors.PyMongoError as e:
-        print(f"[logger] create_alert failed: {e}")
+
+def dispatch_event(kind: str, payload: Dict[str, Any]) -> None:
+    """
+    Queue everything one handler records for a request as a single write.
+    `kind` names the handler (e.g. "login"). payload keys, all optional:
+      - session_activity: {"session_id": ..., **record_session_activity kwargs}
+      - alerts: [{**create_alert kwargs}, ...]; session_id / ip / user_agent
+        default to those of session_activity
+      - deception: dict as passed to log_deception
+    The writer thread expands it into the per-collection writes.
+    """
+    _enqueue("dispatch", (kind, _utc_now_iso(), payload))
+
+
+def _expand_dispatch(item: Tuple[str, str, Dict[str, Any]], grouped: Dict[str, list]) -> None:
+    _kind, now, payload = item
+
+    identity: Dict[str, Any] = {}
+    activity = payload.get("session_activity")
+    if activity:
+        activity = dict(activity)
+        identity = {"session_id": activity["session_id"], "ip": activity["ip"], "user_agent": activity["user_agent"]}
+        grouped["sessions"].append(_session_activity_op(activity.pop("session_id"), now, **activity))
+
+    for alert in payload.get("alerts") or ():
+        alert = {**identity, **alert}
+        grouped["alerts"].append(_alert_doc(
+            now, alert.pop("session_id"), alert.pop("ip"), alert.pop("user_agent"), **alert
+        ))
+
+    deception = payload.get("deception")
+    if deception:
+        grouped["deceptions"].append(_deception_doc(now, deception))
 
 
 # ---------- Query helpers for dashboard ----------
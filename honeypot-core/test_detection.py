@@ -3,9 +3,10 @@
 import sys
 sys.path.insert(0, '.')
 
-from detection.state import DetectionState
-from detection.scoring import score_event, guess_attack_type
-from detection.analytics import severity, leaderboard
+from detection.state import DetectionState, PathWindow, TimeRing
+from detection.scoring import TAG_INDEX, score_event, guess_attack_type
+from detection.analytics import severity, leaderboard, ip_top_tags
+from detection import sentinel
 
 def test_endpoint_weights():
     state = DetectionState()
@@ -18,6 +19,17 @@ def test_endpoint_weights():
     assert "admin-probe" in tags
     print(f"✓ /admin scores {delta} with tags {tags}")
 
+def test_endpoint_first_match_wins():
+    state = DetectionState()
+    ip_state = state.get_ip("1.2.3.5")
+
+    for path, tag in [("/admin/", "admin-probe"), ("/api/admin", "api-probe"), ("/health", "health")]:
+        _, tags, _, reasons = score_event({"path": path, "method": "GET"}, ip_state)
+        assert reasons["endpoint"]["tag"] == tag, f"{path} should map to {tag}, got {reasons['endpoint']}"
+    _, _, _, reasons = score_event({"path": "/adminx", "method": "GET"}, ip_state)
+    assert reasons["endpoint"] is None
+    print("✓ Endpoint patterns resolve in list order")
+
 def test_sqli_detection():
     state = DetectionState()
     ip_state = state.get_ip("5.6.7.8")
@@ -47,6 +59,38 @@ def test_rce_detection():
     assert "rce-attempt" in tags, f"Should detect RCE, got: {tags}"
     print(f"✓ RCE detected: score={delta}, guess={guess}")
 
+def test_time_ring_counts_window():
+    ring = TimeRing(size=4)
+    for ts in [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]:  # wraps; 1.0 and 2.0 are overwritten
+        ring.append(ts)
+    assert len(ring) == 4
+    assert ring.count_since(0.0) == 4
+    assert ring.count_since(4.5) == 2
+    assert ring.count_since(7.0) == 0
+    print("✓ TimeRing counts timestamps in window")
+
+def test_path_window_distinct_paths():
+    window = PathWindow(maxlen=4)
+    for ts, path in [(1.0, "/a"), (2.0, "/b"), (3.0, "/a"), (4.0, "/c")]:
+        window.append(ts, path)
+    assert window.distinct_since(0.0) == 3
+    window.append(5.0, "/d")  # over maxlen: (1.0, "/a") drops, "/a" still seen at 3.0
+    assert window.distinct_since(0.0) == 4
+    assert window.distinct_since(3.5) == 2  # only /c and /d remain
+    assert len(window) == 2
+    print("✓ PathWindow counts distinct paths in window")
+
+def test_ip_state_tail():
+    state = DetectionState()
+    st = state.get_ip("4.4.4.4")
+    for i in range(5):
+        state.add_timeline_event(st, {"n": i})
+    assert [e["n"] for e in st.tail(2)] == [3, 4]
+    assert [e["n"] for e in st.tail(10)] == [0, 1, 2, 3, 4]
+    for k in range(-6, 8):
+        assert st.tail(k) == list(st.timeline)[-k:], f"tail({k}) should match the old slice"
+    print("✓ IPState.tail returns the newest events in order")
+
 def test_severity_thresholds():
     assert severity(0) == "info"
     assert severity(59) == "info"
@@ -77,6 +121,510 @@ def test_leaderboard():
     assert board[2]["severity"] == "info"
     print(f"✓ Leaderboard sorted correctly: {[r['ip'] for r in board]}")
 
+def test_leaderboard_follows_score_updates():
+    state = DetectionState()
+    state.update_score("10.0.0.1", 40)
+    state.update_score("10.0.0.2", 80)
+    state.update_score("10.0.0.1", 120)  # overtakes .2
+
+    board = leaderboard(state, limit=1)
+    assert [r["ip"] for r in board] == ["10.0.0.1"]
+    assert board[0]["score"] == 120
+    assert len(state.by_score) == len(state.by_ip) == 2
+
+    state.get_ip("10.0.0.2").score = 150  # direct writes go through update_score
+    assert [r["ip"] for r in leaderboard(state, limit=1)] == ["10.0.0.2"]
+    assert list(state.by_score) == [(120, "10.0.0.1"), (150, "10.0.0.2")]
+    assert state.stats()["by_severity"]["critical"] == 2
+    print("✓ Leaderboard follows score updates")
+
+def test_concurrent_score_updates_stay_consistent():
+    import threading
+    state = DetectionState()
+    start = threading.Barrier(8)
+
+    def worker():
+        start.wait()
+        for _ in range(200):
+            state.add_score("1.2.3.4", 1)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert state.by_ip["1.2.3.4"].score == 1600
+    assert list(state.by_score) == [(1600, "1.2.3.4")]
+    stats = state.stats()
+    assert sum(stats["by_severity"].values()) == stats["total_ips"] == 1
+    assert stats["by_severity"]["critical"] == 1
+    print("✓ Concurrent score updates keep by_score in step")
+
+def test_concurrent_same_ip_events_keep_windows_consistent():
+    import threading
+    from detection import pipeline as pipeline_mod
+    from detection.scoring import SCORE_CACHE_SIZE
+    pipe = pipeline_mod.DetectionPipeline()
+    start = threading.Barrier(8)
+    results = [[] for _ in range(8)]
+
+    def worker(n):
+        start.wait()
+        for i in range(100):
+            event = {"ip": "5.5.5.5", "path": f"/p{(n * 100 + i) % 40}", "method": "GET",
+                     "user_agent": "sqlmap/1.7" if i % 3 else "curl/8.0"}
+            results[n].append(pipe.process_event(event))
+
+    orig = pipeline_mod.send_alert
+    pipeline_mod.send_alert = lambda alert: None
+    try:
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        pipeline_mod.send_alert = orig
+
+    enriched = [e for r in results for e in r]
+    assert None not in enriched
+    st = pipe.state.by_ip["5.5.5.5"]
+    assert st.score == sum(e["score_delta"] for e in enriched)
+    assert sum(st.tag_counts) == sum(len(e["tags"]) for e in enriched)
+    assert len(st.req_times) == len(st.recent_paths) == 500
+    assert sum(st.recent_paths._counts.values()) == 500
+    assert len(st.score_cache) <= SCORE_CACHE_SIZE
+    print("✓ Concurrent events for one IP keep its scoring windows consistent")
+
+def test_ip_top_tags_memo_follows_version():
+    state = DetectionState()
+    st = state.get_ip("9.9.9.9")
+    st.tag_counts[TAG_INDEX["sqli"]] = 3
+    st.tag_counts[TAG_INDEX["scanner-tool"]] = 1
+    assert ip_top_tags(st, 1) == ["sqli"]
+    assert ip_top_tags(st, 5) == ["sqli", "scanner-tool"]  # unseen tags are left out
+
+    st.tag_counts[TAG_INDEX["scanner-tool"]] = 5
+    assert ip_top_tags(st, 1) == ["sqli"]  # memoized until the version moves
+    st.tags_version += 1
+    assert ip_top_tags(st, 1) == ["scanner-tool"]
+    print("✓ Top tags are recomputed only after a tags change")
+
+def test_prune_old_drops_idle_ips():
+    import time
+    state = DetectionState()
+    now = time.time()
+    old = now - 2 * 3600
+
+    state.touch("idle", old)
+    state.touch("back", old)
+    state.touch("back", now)  # seen again: its old heap entry is stale
+    state.prune_old(max_idle_minutes=60)
+
+    assert "idle" not in state.by_ip
+    assert "back" in state.by_ip
+    assert len(state.by_score) == 1
+    print("✓ prune_old drops idle IPs only")
+
+def test_stats_aggregates_track_updates():
+    import time
+    state = DetectionState()
+    now = time.time()
+
+    state.touch("a", now - 2 * 3600)
+    state.update_score("a", 120)
+    state.set_attack_type(state.get_ip("a"), "sqli")
+    state.add_timeline_event(state.get_ip("a"), {"path": "/login"})
+    state.touch("b", now)
+    state.update_score("b", 70)
+    for i in range(305):  # timeline is capped at 300
+        state.add_timeline_event(state.get_ip("b"), {"path": f"/p{i}"})
+
+    stats = state.stats()
+    assert stats["by_severity"] == {"info": 0, "warn": 1, "critical": 1}
+    assert stats["by_attack_type"] == {"sqli": 1, "unknown": 1}
+    assert stats["total_events"] == 301
+
+    state.prune_old(max_idle_minutes=60)
+    stats = state.stats()
+    assert stats["total_ips"] == 1
+    assert stats["by_severity"] == {"info": 0, "warn": 1, "critical": 0}
+    assert stats["by_attack_type"] == {"unknown": 1}
+    assert stats["total_events"] == 300
+    print("✓ Stats aggregates follow score, guess, timeline and pruning")
+
+def test_sentinel_flush_writes_batch():
+    import json, tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as d:
+        orig = sentinel.SENTINEL_FILE
+        sentinel.SENTINEL_FILE = Path(d) / "alerts.jsonl"
+        try:
+            sentinel.send_alert_batch([{"ip": "1.1.1.1"}, {"ip": "2.2.2.2"}])
+            sentinel.flush()
+            lines = sentinel.SENTINEL_FILE.read_text().splitlines()
+        finally:
+            sentinel.SENTINEL_FILE = orig
+    assert [json.loads(l)["ip"] for l in lines] == ["1.1.1.1", "2.2.2.2"]
+    assert all("emitted_at" in json.loads(l) for l in lines)
+    print("✓ Sentinel batch is written by flush()")
+
+def test_sentinel_drops_unserializable_alerts():
+    import json, tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as d:
+        orig = sentinel.SENTINEL_FILE
+        sentinel.SENTINEL_FILE = Path(d) / "alerts.jsonl"
+        before = sentinel.dropped_count()
+        try:
+            sentinel.send_alert_batch([{"ip": "1.1.1.1", "score": 2 ** 70}, {"ip": "2.2.2.2"}])
+            sentinel.flush()  # must not hang on the bad alert
+            sentinel.send_alert({"ip": "3.3.3.3"})
+            sentinel.flush()
+            lines = sentinel.SENTINEL_FILE.read_text().splitlines()
+        finally:
+            sentinel.SENTINEL_FILE = orig
+    assert [json.loads(l)["ip"] for l in lines] == ["2.2.2.2", "3.3.3.3"]
+    assert sentinel.dropped_count() == before + 1
+    print("✓ Sentinel drops unserializable alerts and keeps writing")
+
+def test_alert_tail_reads_last_lines():
+    import tempfile
+    from pathlib import Path
+    from detection.api import _tail_lines
+
+    with tempfile.TemporaryDirectory() as d:
+        path = Path(d) / "alerts.jsonl"
+        path.write_bytes(b"".join(b'{"n": %d}\n' % i for i in range(200)))
+        assert _tail_lines(path, 3, block=16) == [b'{"n": 197}', b'{"n": 198}', b'{"n": 199}']
+        assert len(_tail_lines(path, 500, block=64)) == 200
+        assert len(_tail_lines(path, 0)) == 200, "limit=0 keeps every line, like lines[-0:]"
+        assert _tail_lines(path, -198) == [b'{"n": 198}', b'{"n": 199}']
+    print("✓ Alert tail returns only the newest lines")
+
+def test_stub_caches_llm_results_only():
+    import deception_stub as stub
+    from deception_engine import _session_profile, _session_id
+
+    calls = []
+    def fake_generate(recent_events, current_request):
+        calls.append(current_request["ip"])
+        tenant = _session_profile(_session_id(current_request))[0]["tenant"]
+        return {
+            "fake_response": {"content_type": "application/json", "status_code": 401,
+                              "body": {"error": {"request_id": "req_0123456789"}, "tenant": tenant}},
+            "fake_logs": ["2026-01-01T00:00:00Z WARN auth req_0123456789 login failed"],
+            "fake_creds": {"token_sample": "tok_abcdef"},
+            "suggested_endpoints": ["/admin"],
+            "risk_score": 50,
+        }, fake_generate.from_llm
+
+    orig = stub.brain_generate_deception
+    stub.brain_generate_deception = fake_generate
+    stub._RESPONSE_CACHE.clear()
+    ctx = {"path": "/login", "method": "POST", "user_agent": "sqlmap/1.7"}
+    try:
+        fake_generate.from_llm = False
+        stub.generate_deception({**ctx, "ip": "10.0.0.1"})
+        stub.generate_deception({**ctx, "ip": "10.0.0.2"})
+        assert calls == ["10.0.0.1", "10.0.0.2"], "fallbacks must not be cached"
+
+        fake_generate.from_llm = True
+        first = stub.generate_deception({**ctx, "ip": "10.0.0.3"})
+        second = stub.generate_deception({**ctx, "ip": "10.0.0.4"})
+        assert calls == ["10.0.0.1", "10.0.0.2", "10.0.0.3"], "LLM result should be reused"
+    finally:
+        stub.brain_generate_deception = orig
+        stub._RESPONSE_CACHE.clear()
+
+    rid = second["content"]["error"]["request_id"]
+    assert rid.startswith("req_") and rid != "req_0123456789"
+    assert rid in second["fake_logs"][0], "ids stay consistent across body and logs"
+    assert not second["fake_logs"][0].startswith("2026-01-01")
+    tenant4 = _session_profile(_session_id({"ip": "10.0.0.4", "user_agent": "sqlmap/1.7"}))[0]["tenant"]
+    assert second["content"]["tenant"] == tenant4
+    second["fake_logs"].append("x")
+    assert len(first["fake_logs"]) == 1, "hits must not share nested values"
+    print("✓ Stub caches LLM results only and re-personalizes hits")
+
+def test_stub_cache_hits_get_fresh_admin_tokens():
+    import deception_stub as stub
+
+    def fake_generate(recent_events, current_request):
+        return {
+            "fake_response": {"content_type": "application/json", "status_code": 403,
+                              "body": {"session": "sess_00aa11bb", "token": "adm_tok_0123456789abcd"}},
+            "fake_logs": ["WARN admin access denied token=adm_tok_0123456789abcd"],
+            "fake_creds": {"token_sample": "adm_tok_0123456789abcd"},
+            "suggested_endpoints": [],
+            "risk_score": 80,
+        }, True
+
+    orig = stub.brain_generate_deception
+    stub.brain_generate_deception = fake_generate
+    stub._RESPONSE_CACHE.clear()
+    ctx = {"path": "/admin", "method": "GET", "user_agent": "curl/8.0"}
+    try:
+        stub.generate_deception({**ctx, "ip": "10.0.1.1"})
+        hits = [stub.generate_deception({**ctx, "ip": ip}) for ip in ("10.0.1.2", "10.0.1.3")]
+    finally:
+        stub.brain_generate_deception = orig
+        stub._RESPONSE_CACHE.clear()
+
+    tokens = [h["fake_creds"]["token_sample"] for h in hits]
+    assert all(t.startswith("adm_tok_") and len(t) == len("adm_tok_0123456789abcd") for t in tokens)
+    assert len({"adm_tok_0123456789abcd", *tokens}) == 3, "each hit needs its own admin token"
+    for h, token in zip(hits, tokens):
+        assert h["content"]["token"] == token and token in h["fake_logs"][0]
+        assert h["content"]["session"] != "sess_00aa11bb"
+    print("✓ Stub cache hits get fresh admin tokens")
+
+def test_active_session_outlives_its_ttl():
+    import deception_engine as de
+    from cachetools import TTLCache
+    now = [0.0]
+    saved = de._SESSION
+    de._SESSION = TTLCache(maxsize=16, ttl=3600, timer=lambda: now[0])
+    try:
+        de.push_event("active", {"path": "/login"})
+        de.push_event("idle", {"path": "/login"})
+        for _ in range(3):
+            now[0] += 3000
+            de.push_event("active", {"path": "/admin"})
+        assert "idle" not in de._SESSION, "an idle session still expires"
+        assert de._SESSION["active"]["hits"] == {"/login": 1, "/admin": 3}
+    finally:
+        de._SESSION = saved
+    print("✓ push_event keeps an active session from expiring")
+
+def test_single_provider_gets_the_route_deadline():
+    import asyncio, time
+    import deception_engine as de
+
+    class SlowLLM:
+        def invoke(self, prompt, max_tokens=None):
+            time.sleep(1.2)
+            return "late"
+
+        async def ainvoke(self, prompt, max_tokens=None):
+            await asyncio.sleep(1.2)
+            return "late"
+
+    saved = (de._get_llms, de._loop_llms, dict(de._FAILED_AT))
+    de._get_llms = de._loop_llms = lambda: [SlowLLM()]
+    de._FAILED_AT.clear()
+    try:
+        assert de._invoke_with_fallback("p", de._DEADLINE_LOGIN, 10) == "late"
+        assert asyncio.run(de._ainvoke_with_fallback("p", de._DEADLINE_LOGIN, 10)) == "late"
+        assert de._FAILED_AT == {}, "a slow success must not start a cooldown"
+    finally:
+        de._get_llms, de._loop_llms = saved[:2]
+        de._FAILED_AT.clear()
+        de._FAILED_AT.update(saved[2])
+    print("✓ The last provider gets the rest of the route deadline")
+
+def _old_valid_payload(p, content_type, status):
+    # The dict-walking validator the msgspec decoders replaced, for parity checks.
+    try:
+        if not {"fake_response", "fake_creds", "fake_logs", "suggested_endpoints", "risk_score"} <= p.keys():
+            return False
+        fr = p["fake_response"]
+        if not isinstance(fr, dict) or fr.get("content_type") != content_type or int(fr.get("status_code", 0)) != status:
+            return False
+        if status == 401:
+            err = fr["body"].get("error") if isinstance(fr.get("body"), dict) else None
+            if not isinstance(err, dict) or int(err.get("code", 0)) != 401:
+                return False
+            if not isinstance(err.get("message"), str) or not isinstance(err.get("request_id"), str):
+                return False
+            if not isinstance(err.get("retry_after"), (int, float)):
+                return False
+        elif not isinstance(fr.get("body"), str):
+            return False
+        if not isinstance(p["fake_creds"], dict) or not isinstance(p["fake_logs"], list):
+            return False
+        if not isinstance(p["suggested_endpoints"], list) or not isinstance(p["risk_score"], int):
+            return False
+        return 0 <= p["risk_score"] <= 100
+    except Exception:
+        return False
+
+def test_payload_decoder_matches_old_validator():
+    import copy, json
+    import deception_engine as de
+
+    login = {
+        "fake_response": {"content_type": "application/json", "status_code": 401, "body": {
+            "error": {"code": 401, "message": "Invalid credentials", "request_id": "req_1", "retry_after": 5}}},
+        "fake_creds": {}, "fake_logs": [], "suggested_endpoints": [], "risk_score": 50,
+    }
+    admin = {**copy.deepcopy(login), "fake_response": {"content_type": "text/html", "status_code": 403, "body": "<h1>Denied</h1>"}}
+    common = [
+        (("risk_score",), [101, -1, "50", 50.0, True, None, KeyError]),
+        (("fake_response", "status_code"), ["abc", 200, KeyError]),
+        (("fake_response", "content_type"), ["text/plain", KeyError]),
+        (("fake_creds",), [[], "x"]),
+        (("fake_logs",), [{}, "x"]),
+        (("suggested_endpoints",), [None]),
+    ]
+    login_only = [
+        (("fake_response", "status_code"), [403, "401", 401.0]),
+        (("fake_response", "body", "error", "code"), [400, "401", 401.0, "x"]),
+        (("fake_response", "body", "error", "message"), [5, KeyError]),
+        (("fake_response", "body", "error", "retry_after"), [2.5, "5", True, KeyError]),
+        (("fake_response", "body"), ["str"]),
+    ]
+    admin_only = [
+        (("fake_response", "status_code"), [401, "403", 403.0]),
+        (("fake_response", "body"), [{}, 5]),
+    ]
+
+    def variants(base, mutations):
+        yield base
+        for path, values in mutations:
+            for value in values:
+                case = copy.deepcopy(base)
+                target = case
+                for key in path[:-1]:
+                    target = target[key]
+                if value is KeyError:
+                    del target[path[-1]]
+                else:
+                    target[path[-1]] = value
+                yield case
+
+    checked = 0
+    for base, decoder, ct, status, extra in (
+        (login, de._LOGIN_DECODER, "application/json", 401, login_only),
+        (admin, de._ADMIN_DECODER, "text/html", 403, admin_only),
+    ):
+        for case in variants(base, common + extra):
+            old = _old_valid_payload(case, ct, status)
+            new = de._decode_payload(json.dumps(case), decoder) is not None
+            assert old == new, f"parity broken for {case}: old={old} new={new}"
+            checked += 1
+    # Still accepted when the model wraps the JSON in prose
+    assert de._decode_payload("Sure! " + json.dumps(login) + " Done.", de._LOGIN_DECODER) is not None
+    print(f"✓ msgspec decoders match the old validators on {checked} payloads")
+
+class _FakeCollection:
+    def __init__(self, docs=None):
+        self.docs, self.ops, self.found = [], [], dict(docs or {})
+
+    def insert_many(self, docs, ordered=False):
+        self.docs.extend(docs)
+
+    def bulk_write(self, ops, ordered=True):
+        self.ops.extend(ops)
+
+    def find_one(self, query, projection=None):
+        return self.found.get(query.get("username"))
+
+def _with_fake_db(logger, **collections):
+    """Point logger at fake collections; returns a restore callback."""
+    saved = {name: getattr(logger, name) for name in ["init_db", *collections]}
+    logger.init_db = lambda: True
+    for name, coll in collections.items():
+        setattr(logger, name, coll)
+    return lambda: [setattr(logger, name, value) for name, value in saved.items()]
+
+def test_logger_writer_flushes_in_order():
+    import logger
+    events, deceptions, alerts, sessions = (_FakeCollection() for _ in range(4))
+    restore = _with_fake_db(logger, _events=events, _deceptions=deceptions, _alerts=alerts, _sessions=sessions)
+    try:
+        logged = [logger.log_event({"path": f"/p{i}"}) for i in range(50)]
+        logged[-1]["score_total"] = 1  # as the pipeline's in-place enrichment does
+        assert logger.EVENT_LOGS[-1]["event_id"] == logged[-1]["event_id"]
+        assert "score_total" not in logger.EVENT_LOGS[-1], "the in-memory log keeps its own copy"
+        logger.upsert_session("s1", {"ip": "1.1.1.1"})
+        logger.update_session_max_risk("s1", 80)
+        logger.dispatch_event("login", {
+            "session_activity": {"session_id": "s1", "ip": "1.1.1.1", "user_agent": "ua", "path": "/login",
+                                 "method": "POST", "status_code": 401, "risk": 70},
+            "alerts": [{"severity": "HIGH", "alert_type": "bruteforce", "reason": "r", "risk": 70}],
+        })
+        logger.flush()
+    finally:
+        restore()
+
+    assert [d["event_id"] for d in events.docs] == [e["event_id"] for e in logged]
+    assert events.docs[0] is not logged[0], "the writer must get its own copy"
+    assert [list(op._doc) for op in sessions.ops][:2] == [["$set", "$setOnInsert", "$inc"], ["$max"]]
+    assert len(sessions.ops) == 3 and sessions.ops[2]._doc["$set"]["last_path"] == "/login"
+    assert [a["ip"] for a in alerts.docs] == ["1.1.1.1"]
+    print("✓ Logger writer flushes batches in arrival order")
+
+def test_dispatch_expands_into_collection_writes():
+    import logger
+    now = "2026-01-01T00:00:00+00:00"
+    activity = {"session_id": "s1", "ip": "1.1.1.1", "user_agent": "ua", "path": "/admin",
+                "method": "GET", "status_code": 403, "risk": 90, "flags": ["admin_probe"]}
+    payload = {
+        "session_activity": activity,
+        "alerts": [{"severity": "CRITICAL", "alert_type": "admin_probe", "reason": "r", "risk": 90},
+                   {"ip": "9.9.9.9", "severity": "HIGH", "alert_type": "x", "reason": "r", "risk": 60}],
+        "deception": {"session_id": "s1", "path": "/admin"},
+    }
+    grouped = {k: [] for k in ("events", "deceptions", "alerts", "sessions")}
+    logger._expand_dispatch(("admin", now, payload), grouped)
+
+    expected_op = logger._session_activity_op(
+        "s1", now, ip="1.1.1.1", user_agent="ua", path="/admin", method="GET",
+        status_code=403, risk=90, flags=["admin_probe"],
+    )
+    assert grouped["sessions"] == [expected_op]
+    first, second = grouped["alerts"]
+    assert (first["session_id"], first["ip"], first["user_agent"], first["timestamp"]) == ("s1", "1.1.1.1", "ua", now)
+    assert first["type"] == "admin_probe" and first["status"] == "OPEN"
+    assert second["ip"] == "9.9.9.9", "explicit alert fields win over the session identity"
+    assert grouped["deceptions"][0]["timestamp"] == now and grouped["deceptions"][0]["path"] == "/admin"
+    assert activity["session_id"] == "s1", "payload must not be mutated"
+    print("✓ dispatch_event expands into session, alert and deception writes")
+
+def test_lookup_user_single_read():
+    import logger
+    users = _FakeCollection({
+        "alice": {"password_hash": "h1", "role": "admin"},
+        "bob": {"password_hash": "h2", "role": "user", "is_active": False},
+        "carol": {"role": "user"},
+    })
+    restore = _with_fake_db(logger, _users=users)
+    try:
+        assert logger.lookup_user("alice") == (True, "h1", "admin")
+        assert logger.lookup_user("bob") == (True, None, "user")
+        assert logger.lookup_user("carol") == (True, None, "user")
+        assert logger.lookup_user("mallory") == (False, None, None)
+        assert logger.lookup_user("") == (False, None, None)
+    finally:
+        restore()
+    print("✓ lookup_user reports existence, usable hash and role")
+
+def test_prompt_parts_match_template_format():
+    import deception_engine as de
+    values = ('{"org_name": "Acme {x}", "note": "é"}', '[{"path": "/login"}]', '{"body": "}}{{"}')
+    for template, parts in ((de.LOGIN_PROMPT, de._LOGIN_PARTS), (de.ADMIN_PROMPT, de._ADMIN_PARTS)):
+        expected = template.format(env_profile_json=values[0], recent_events_json=values[1], current_request_json=values[2])
+        assert de._build_prompt(parts, *values) == expected
+    print("✓ Prebuilt prompt parts are byte-identical to template.format()")
+
+def test_session_hit_counters_follow_window():
+    import deception_engine as de
+    sid = "test-hit-counters"
+    req = {"session_id": sid, "path": "/login", "method": "POST", "body": {"username": "x"}}
+    pushed = []
+    for i in range(27):
+        path = "/admin" if i % 4 == 0 else ("/LOGIN" if i % 2 else "/health")
+        de.push_event(sid, {"path": path, "method": "GET"})
+        pushed.append({"path": path})
+        window = [p["path"].lower() for p in pushed[-de.RECENT_EVENTS_MAX:]]
+        assert de._recent_hits(req, []) == (window.count("/login"), window.count("/admin"))
+        assert de.compute_risk(req) == de.compute_risk(req, pushed[-de.RECENT_EVENTS_MAX:])
+    print("✓ Session hit counters track the recent-events window")
+
 def test_attack_type_guess():
     # RCE should take priority
     assert guess_attack_type(["sqli", "rce-attempt"]) == "rce"
@@ -89,9 +637,32 @@ def test_attack_type_guess():
 if __name__ == "__main__":
     print("Running detection tests...\n")
     test_endpoint_weights()
+    test_endpoint_first_match_wins()
     test_sqli_detection()
     test_rce_detection()
+    test_time_ring_counts_window()
+    test_path_window_distinct_paths()
+    test_ip_state_tail()
     test_severity_thresholds()
     test_leaderboard()
+    test_leaderboard_follows_score_updates()
+    test_concurrent_score_updates_stay_consistent()
+    test_concurrent_same_ip_events_keep_windows_consistent()
+    test_ip_top_tags_memo_follows_version()
+    test_prune_old_drops_idle_ips()
+    test_stats_aggregates_track_updates()
+    test_sentinel_flush_writes_batch()
+    test_sentinel_drops_unserializable_alerts()
+    test_alert_tail_reads_last_lines()
+    test_stub_caches_llm_results_only()
+    test_stub_cache_hits_get_fresh_admin_tokens()
+    test_active_session_outlives_its_ttl()
+    test_single_provider_gets_the_route_deadline()
+    test_logger_writer_flushes_in_order()
+    test_dispatch_expands_into_collection_writes()
+    test_lookup_user_single_read()
+    test_prompt_parts_match_template_format()
+    test_session_hit_counters_follow_window()
+    test_payload_decoder_matches_old_validator()
     test_attack_type_guess()
     print("\n✅ All tests passed!")
\ No newline at end of file